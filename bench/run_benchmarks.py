@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2008 Stephen Hansen <shansen@advpubtech.com>
+# Copyright (C) 2009 Rowan Wookey <support@obsidianproject.co.uk>
+# Copyright (C) 2008-2009 www.obsidianproject.co.uk
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+"""Benchmarks for the hooks of the BlackMagicTicketTweaks plugin.
+
+Each run builds a throwaway Trac environment on SQLite, populated with the
+requested number of tickets, ticket types, enchanted fields and
+`ticket_type.*` permissions, then times the plugin hooks against it:
+
+    python bench/run_benchmarks.py --rows 100,1000,5000 --fields 2,10,30 \\
+        --output results.json
+
+Every combination of `--rows` and `--fields` is a separate environment, so
+lists make scaling sweeps. Results are written as JSON, to be compared
+across plugin versions with `--compare old.json`.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import trac
+import tracopt.perm.config_perm_provider
+import trac.ticket.query
+import trac.ticket.report
+import trac.ticket.roadmap
+import trac.ticket.web_ui
+import trac.timeline.web_ui
+from genshi.input import HTML
+from trac.env import Environment
+from trac.perm import PermissionCache, PermissionSystem
+from trac.resource import Resource
+from trac.test import MockRequest
+from trac.ticket.model import Ticket
+from trac.ticket.query import QueryModule
+from trac.ticket.report import ReportModule
+from trac.ticket.web_ui import TicketModule
+from trac.web.chrome import Chrome
+
+import blackmagic
+from blackmagic.blackmagic import BlackMagicTicketTweaks
+
+# the kinds of enchantment given to the generated fields, in turn
+KINDS = ('permission', 'hide', 'disable', 'label', 'notice', 'tip')
+
+ADMIN = 'admin'
+RESTRICTED = 'restricted'
+
+
+def create_environment(path, rows, fields, types, type_perms):
+    """Create a Trac environment in `path` with `rows` tickets spread over
+    `types` ticket types, of which `type_perms` are restricted by a
+    `ticket_type.*` permission, and `fields` enchanted custom fields."""
+    type_names = ['type%d' % i for i in xrange(types)]
+    field_names = ['cf%d' % i for i in xrange(fields)]
+    perm_names = ['TYPE%d_VIEW' % i for i in xrange(type_perms)] + \
+                 ['FIELD_EDIT']
+    options = [
+        ('components', 'blackmagic.*', 'enabled'),
+        ('components', 'tracopt.perm.config_perm_provider.*', 'enabled'),
+        ('trac', 'permission_policies', 'BlackMagicTicketTweaks, '
+         'DefaultPermissionPolicy, LegacyAttachmentPolicy'),
+        ('extra-permissions', 'blackmagic', ', '.join(perm_names)),
+        ('blackmagic', 'tweaks', ', '.join(field_names)),
+    ]
+    for i, name in enumerate(field_names):
+        options.append(('ticket-custom', name, 'text'))
+        kind = KINDS[i % len(KINDS)]
+        if kind == 'permission':
+            options.append(('blackmagic', '%s.permission' % name,
+                            'FIELD_EDIT'))
+            options.append(('blackmagic', '%s.ondenial' % name,
+                            ('hide', 'disable')[i % 2]))
+        elif kind in ('hide', 'disable'):
+            options.append(('blackmagic', '%s.%s' % (name, kind), 'true'))
+        else:
+            options.append(('blackmagic', '%s.%s' % (name, kind),
+                            'Generated %s for %s' % (kind, name)))
+    for i in xrange(type_perms):
+        options.append(('blackmagic', 'ticket_type.%s' % type_names[i],
+                        perm_names[i]))
+    env = Environment(path, create=True, options=options)
+
+    with env.db_transaction as db:
+        db("DELETE FROM enum WHERE type='ticket_type'")
+        db.executemany("INSERT INTO enum (type, name, value) VALUES "
+                       "('ticket_type', %s, %s)",
+                       [(name, str(i)) for i, name in enumerate(type_names)])
+        now = int(time.time() * 1000000)
+        db.executemany("""
+            INSERT INTO ticket (id, type, time, changetime, component,
+                                priority, owner, reporter, status, summary,
+                                description)
+            VALUES (%s, %s, %s, %s, 'component1', 'major', 'somebody',
+                    'reporter', 'new', %s, 'Description')
+            """, [(tid, type_names[tid % types], now, now,
+                   'Ticket %d' % tid) for tid in xrange(1, rows + 1)])
+        db.executemany("INSERT INTO ticket_custom (ticket, name, value) "
+                       "VALUES (%s, %s, %s)",
+                       [(tid, name, 'value %d' % tid)
+                        for tid in xrange(1, rows + 1)
+                        for name in field_names])
+        columns = ', '.join('c%d.value AS %s' % (i, name)
+                            for i, name in enumerate(field_names))
+        joins = ' '.join("LEFT JOIN ticket_custom c%d ON c%d.ticket=t.id "
+                         "AND c%d.name='%s'" % (i, i, i, name)
+                         for i, name in enumerate(field_names))
+        db("INSERT INTO report (author, title, query, description) "
+           "VALUES ('admin', 'Benchmark', %s, '')",
+           ("SELECT t.id AS ticket, t.summary, t.type%s FROM ticket t %s "
+            "ORDER BY t.id" % (', ' + columns if columns else '', joins),))
+        report_id = db("SELECT max(id) FROM report")[0][0]
+
+    ps = PermissionSystem(env)
+    ps.grant_permission(ADMIN, 'TRAC_ADMIN')
+    for name in perm_names:
+        ps.grant_permission(ADMIN, name)
+    for name in ('TICKET_VIEW', 'TICKET_MODIFY', 'REPORT_VIEW'):
+        ps.grant_permission(RESTRICTED, name)
+    return env, report_id, field_names
+
+
+class Timer(object):
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = []
+
+    def time(self, name, func, setup=None, calls=1, **params):
+        """Time `func` `repeat` times, calling `setup` beforehand and
+        outside of the measurement. `calls` is the number of hook calls
+        made by one run of `func`."""
+        timings = []
+        for i in xrange(self.repeat):
+            args = setup() if setup else ()
+            gc.collect()
+            gc.disable()
+            try:
+                start = time.time()
+                func(*args)
+                timings.append(time.time() - start)
+            finally:
+                gc.enable()
+        timings.sort()
+        result = dict(params, benchmark=name, calls=calls,
+                      repeat=self.repeat, min=timings[0],
+                      median=timings[len(timings) // 2],
+                      mean=sum(timings) / len(timings),
+                      per_call=timings[0] / calls)
+        self.results.append(result)
+        print >> sys.stderr, '%-40s %10.3f ms  (%s)' % (
+            name, result['min'] * 1000,
+            ', '.join('%s=%s' % item for item in sorted(params.items())))
+        return result
+
+
+def run_scenario(timer, workdir, rows, fields, types, type_perms):
+    path = os.path.join(workdir, 'env-%d-%d' % (rows, fields))
+    env, report_id, field_names = create_environment(path, rows, fields,
+                                                     types, type_perms)
+    bm = BlackMagicTicketTweaks(env)
+    params = {'rows': rows, 'fields': fields, 'types': types,
+              'type_perms': type_perms}
+    ids = range(1, rows + 1)
+    # a ticket of a type without ticket_type.* permission
+    tid = str(type_perms or types)
+
+    for user in (ADMIN, RESTRICTED):
+        params['user'] = user
+
+        # check_permission, with a cold and a warm ticket type cache
+        def check_all(perm):
+            for tid in ids:
+                bm.check_permission('TICKET_VIEW', user,
+                                    Resource('ticket', tid), perm)
+
+        def cold():
+            # older versions of the plugin have no ticket type cache
+            ticket_types = getattr(bm, '_ticket_types', None)
+            if ticket_types is not None:
+                ticket_types.clear()
+            return PermissionCache(env, user),
+        timer.time('check_permission.cold', check_all, cold,
+                   calls=rows, **params)
+        timer.time('check_permission.warm', check_all,
+                   lambda: (PermissionCache(env, user),), calls=rows,
+                   **params)
+
+        # post_process_request, on the data prepared by the core handlers
+        def prepared(module, path_info, args):
+            req = MockRequest(env, authname=user, path_info=path_info,
+                              args=args)
+            bm.pre_process_request(req, None)
+            template, data, content_type = \
+                module(env).process_request(req)[:3]
+            return req, template, data, content_type
+
+        # the core handler runs again before each measurement, as the hook
+        # modifies the data in place
+        pages = (
+            ('report_view.html', ReportModule, '/report/%d' % report_id,
+             {'id': str(report_id), 'max': str(rows)}),
+            ('query.html', QueryModule, '/query',
+             {'col': ['id', 'summary', 'type'] + field_names,
+              'status': '!closed', 'max': str(rows), 'order': 'id'}),
+            ('ticket.html', TicketModule, '/ticket/' + tid, {'id': tid}),
+        )
+        for name, module, path_info, args in pages:
+            timer.time('post_process_request.%s' % name,
+                       bm.post_process_request,
+                       lambda: prepared(module, path_info, dict(args)),
+                       **params)
+
+        # validate_ticket on a ticket whose enchanted fields are unchanged
+        def validate():
+            req = MockRequest(env, authname=user, path_info='/ticket/' + tid)
+            t = Ticket(env, tid)
+            t['summary'] = 'Changed'
+            return req, t
+        timer.time('validate_ticket', bm.validate_ticket, validate,
+                   **params)
+
+        # filter_stream alone, then the complete ticket page rendering
+        req, template, data, content_type = \
+            prepared(TicketModule, '/ticket/' + tid, {'id': tid})
+        page = Chrome(env).render_template(req, template, data,
+                                           content_type)
+
+        def stream_setup():
+            return HTML(page, encoding='utf-8'),
+
+        def filter_only(stream):
+            for event in bm.filter_stream(req, 'GET', 'ticket.html', stream,
+                                          data):
+                pass
+        timer.time('filter_stream.ticket.html', filter_only, stream_setup,
+                   **params)
+
+        def render(req, template, data, content_type):
+            Chrome(env).render_template(req, template, data, content_type)
+        timer.time('render.ticket.html', render,
+                   lambda: prepared(TicketModule, '/ticket/' + tid,
+                                    {'id': tid}),
+                   **params)
+
+    env.shutdown()
+
+
+def compare(old, new):
+    def key(r):
+        return (r['benchmark'], r['rows'], r['fields'], r['types'],
+                r['type_perms'], r['user'])
+    before = dict((key(r), r) for r in old['results'])
+    for r in new['results']:
+        o = before.get(key(r))
+        if o is None:
+            continue
+        print '%-40s %-11s rows=%-6d fields=%-4d %10.3f -> %10.3f ms ' \
+              '(%+.0f%%)' % (r['benchmark'], r['user'], r['rows'],
+                             r['fields'], o['min'] * 1000, r['min'] * 1000,
+                             (r['min'] / o['min'] - 1) * 100
+                             if o['min'] else 0)
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def int_list(value):
+    return [int(x) for x in value.split(',') if x.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int_list, default=[100, 1000],
+                        help="comma separated numbers of tickets")
+    parser.add_argument('--fields', type=int_list, default=[2, 10],
+                        help="comma separated numbers of enchanted fields")
+    parser.add_argument('--types', type=int, default=4,
+                        help="number of ticket types")
+    parser.add_argument('--type-perms', type=int, default=2,
+                        help="number of ticket types restricted by a "
+                             "ticket_type.* permission, at most one less "
+                             "than --types")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="number of timed runs of each benchmark")
+    parser.add_argument('--label', default=None,
+                        help="name of the measured plugin version, the git "
+                             "revision by default")
+    parser.add_argument('--output', default=None,
+                        help="write the results to this JSON file")
+    parser.add_argument('--compare', default=None,
+                        help="JSON results of a previous run to compare "
+                             "with")
+    args = parser.parse_args(argv)
+
+    timer = Timer(args.repeat)
+    workdir = tempfile.mkdtemp(prefix='blackmagic-bench-')
+    try:
+        for rows in args.rows:
+            for fields in args.fields:
+                run_scenario(timer, workdir, rows, fields, args.types,
+                             min(args.type_perms, args.types - 1))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        'meta': {
+            'label': args.label or revision(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'trac': trac.__version__,
+            'plugin': os.path.dirname(blackmagic.__file__),
+        },
+        'results': timer.results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
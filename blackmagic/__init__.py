@@ -1 +1,4 @@
+import assets
+import audit
 import blackmagic
+import stats
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2008 Stephen Hansen <shansen@advpubtech.com>
+# Copyright (C) 2009 Rowan Wookey <support@obsidianproject.co.uk>
+# Copyright (C) 2008-2009 www.obsidianproject.co.uk
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import gzip
+import hashlib
+import os
+import re
+import threading
+from cStringIO import StringIO
+
+from trac.config import BoolOption
+from trac.core import Component, implements
+from trac.web.api import IRequestHandler, RequestDone
+
+# the extensions must come after the library they extend
+TOOLTIP_SCRIPTS = ('wz_tooltip.js', 'tip_centerwindow.js',
+                   'tip_followscroll.js')
+
+_JS_DIR = os.path.join(os.path.dirname(__file__), 'htdocs', 'js')
+_TRAILING_COMMENT_RE = re.compile(r'^([^\'"/]*?)\s*//.*$')
+_FAR_FUTURE = 'public, max-age=31536000, immutable'
+
+_LAZY_LOADER = """\
+function Tip(){window.tt_lazyArgs=arguments;if(window.tt_lazyLoad)return;\
+window.tt_lazyLoad=1;var s=document.createElement('script');\
+s.type='text/javascript';s.src='%s';\
+s.onload=s.onreadystatechange=function(){\
+if(s.readyState&&!/loaded|complete/.test(s.readyState))return;\
+s.onload=s.onreadystatechange=null;\
+if(window.tt_lazyArgs)Tip.apply(window,window.tt_lazyArgs)};\
+document.getElementsByTagName('head')[0].appendChild(s)}\
+function UnTip(){window.tt_lazyArgs=null}"""
+
+
+def minify_script(source):
+    """Strip the comments and the indentation of a script.
+
+    The leading comment block, holding the license notice, is kept as is.
+    Line breaks are kept as well since the scripts rely on automatic
+    semicolon insertion; trailing `//` comments are only removed from lines
+    without any quote or slash before them.
+    """
+    lines = source.splitlines()
+    result = []
+    in_comment = False
+    header = True
+    for line in lines:
+        stripped = line.strip()
+        if in_comment:
+            if header:
+                result.append(line.rstrip())
+            if '*/' in stripped:
+                in_comment = False
+                header = False
+            continue
+        if stripped.startswith('/*'):
+            in_comment = '*/' not in stripped[2:]
+            if header:
+                result.append(line.rstrip())
+                header = in_comment
+            continue
+        header = False
+        if not stripped or stripped.startswith('//'):
+            continue
+        match = _TRAILING_COMMENT_RE.match(stripped)
+        if match:
+            stripped = match.group(1)
+        result.append(stripped)
+    return '\n'.join(result) + '\n'
+
+
+class ScriptBundle(object):
+    """Concatenated and minified scripts, along with their gzip encoding and
+    a content hash used to build a cache-friendly file name."""
+
+    def __init__(self, name, paths):
+        sources = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                sources.append(minify_script(f.read()))
+        self.content = ';\n'.join(sources)
+        self.digest = hashlib.sha1(self.content).hexdigest()[:12]
+        self.filename = '%s.%s.js' % (name, self.digest)
+        self.etag = '"%s"' % self.digest
+        buf = StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+        try:
+            f.write(self.content)
+        finally:
+            f.close()
+        self.gzipped = buf.getvalue()
+
+
+_bundle = None
+_bundle_lock = threading.Lock()
+
+
+def tooltip_bundle():
+    """Return the tooltip library bundle, built on first use."""
+    global _bundle
+    if _bundle is None:
+        with _bundle_lock:
+            if _bundle is None:
+                _bundle = ScriptBundle('tooltip',
+                                       [os.path.join(_JS_DIR, name)
+                                        for name in TOOLTIP_SCRIPTS])
+    return _bundle
+
+
+class BlackMagicAssetsModule(Component):
+    """Serves the bundled tooltip scripts at `/blackmagic/js/`, under a
+    content-hashed name so that browsers can cache them forever."""
+
+    implements(IRequestHandler)
+
+    tooltip_lazy = BoolOption('blackmagic', 'tooltip_lazy', False, """
+        If enabled, ticket pages only get a small loader and the tooltip
+        library is fetched when a tip is hovered for the first time.""")
+
+    def tooltip_href(self, req):
+        return req.href('blackmagic', 'js', tooltip_bundle().filename)
+
+    def tooltip_script(self, req):
+        """Return the element loading the tooltip library, to be added once
+        to a page showing tips."""
+        from genshi.builder import tag
+        from genshi.core import Markup
+        href = self.tooltip_href(req)
+        if self.tooltip_lazy:
+            return tag.script(Markup(_LAZY_LOADER % href),
+                              type='text/javascript')
+        return tag.script(type='text/javascript', src=href)
+
+    # IRequestHandler methods
+
+    def match_request(self, req):
+        match = re.match(r'/blackmagic/js/tooltip(?:\.([0-9a-f]+))?\.js$',
+                         req.path_info)
+        if match:
+            req.args['digest'] = match.group(1)
+            return True
+        return False
+
+    def process_request(self, req):
+        bundle = tooltip_bundle()
+        if req.args.get('digest') == bundle.digest:
+            cache_control = _FAR_FUTURE
+        else:
+            # stale or unversioned name, don't let it stick
+            cache_control = 'must-revalidate'
+        if req.get_header('If-None-Match') == bundle.etag:
+            req.send_response(304)
+            req.send_header('Cache-Control', cache_control)
+            req.send_header('ETag', bundle.etag)
+            req.end_headers()
+            raise RequestDone
+        content = bundle.content
+        encoding = None
+        if 'gzip' in (req.get_header('Accept-Encoding') or ''):
+            content = bundle.gzipped
+            encoding = 'gzip'
+        req.send_response(200)
+        req.send_header('Content-Type', 'text/javascript;charset=utf-8')
+        req.send_header('Content-Length', len(content))
+        req.send_header('Cache-Control', cache_control)
+        req.send_header('ETag', bundle.etag)
+        req.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            req.send_header('Content-Encoding', encoding)
+        req.end_headers()
+        if req.method != 'HEAD':
+            req.write(content)
+        raise RequestDone
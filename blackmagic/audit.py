@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2008 Stephen Hansen <shansen@advpubtech.com>
+# Copyright (C) 2009 Rowan Wookey <support@obsidianproject.co.uk>
+# Copyright (C) 2008-2009 www.obsidianproject.co.uk
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import json
+import logging
+import re
+import threading
+import time
+from collections import deque
+
+from trac.core import Component, implements
+from trac.web.api import IRequestHandler
+
+# outcomes of the decisions
+DENIED = 'denied'
+HIDDEN = 'hidden'
+DISABLED = 'disabled'
+REJECTED = 'rejected'
+
+
+class DecisionLog(object):
+    """Fixed-size, thread-safe record of the decisions taken by the plugin.
+
+    A decision is kept as a plain tuple of who (`user`), where (`ticket`),
+    what (`field`, with its `value` for the ticket type), which permissions
+    the rule requires (`rule`) and its `outcome`. The tuples are only turned
+    into text when read, or when `log` is enabled for debug messages. The
+    oldest decisions are dropped once `maxlen` are held; a `maxlen` of 0
+    disables the record.
+    """
+
+    def __init__(self, maxlen, log=None):
+        self.maxlen = max(0, int(maxlen))
+        self.log = log
+        self._entries = deque(maxlen=self.maxlen)
+        self._lock = threading.Lock()
+
+    def record(self, user, ticket, field, rule, outcome, value=None):
+        if self.maxlen:
+            entry = (time.time(), user, ticket, field, value, rule, outcome)
+            with self._lock:
+                self._entries.append(entry)
+        if self.log is not None and self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("BlackMagic decision: %s",
+                           self.format(self.to_dict((0, user, ticket, field,
+                                                     value, rule, outcome))))
+
+    def entries(self):
+        """Return the decisions held, oldest first, as dicts ready to be
+        serialized."""
+        with self._lock:
+            entries = list(self._entries)
+        return [self.to_dict(entry) for entry in entries]
+
+    @staticmethod
+    def to_dict(entry):
+        when, user, ticket, field, value, rule, outcome = entry
+        if isinstance(rule, basestring):
+            rule = [rule]
+        return {'time': when, 'user': user, 'ticket': ticket, 'field': field,
+                'value': value, 'rule': list(rule or ()), 'outcome': outcome}
+
+    @staticmethod
+    def format(d):
+        """Return decision `d`, as returned by `entries`, as a line."""
+        subject = d['field']
+        if d['value'] is not None:
+            subject = '%s %s' % (subject, d['value'])
+        if d['ticket'] is not None:
+            subject = '#%s %s' % (d['ticket'], subject)
+        rule = ', needs %s' % ' or '.join(d['rule']) if d['rule'] else ''
+        return '%s %s for %s%s' % (subject, d['outcome'], d['user'], rule)
+
+
+class BlackMagicAuditModule(Component):
+    """Serves the latest decisions of the plugin as JSON, at
+    `/blackmagic/decisions`, to users having the `TRAC_ADMIN` permission.
+    They can be narrowed down with the `user` and `ticket` arguments."""
+
+    implements(IRequestHandler)
+
+    # IRequestHandler methods
+
+    def match_request(self, req):
+        return re.match(r'/blackmagic/decisions/?$', req.path_info) is not None
+
+    def process_request(self, req):
+        from .blackmagic import BlackMagicTicketTweaks
+        req.perm.require('TRAC_ADMIN')
+        log = BlackMagicTicketTweaks(self.env).decisions
+        user = req.args.get('user')
+        ticket = req.args.get('ticket')
+        entries = []
+        for d in log.entries():
+            if user and d['user'] != user or \
+                    ticket and str(d['ticket']) != ticket:
+                continue
+            d['message'] = log.format(d)
+            entries.append(d)
+        req.send(json.dumps({'size': log.maxlen, 'decisions': entries},
+                            sort_keys=True),
+                 'application/json')
@@ -9,23 +9,56 @@
 # you should have received as part of this distribution.
 #
 
-from genshi.builder import tag
-from genshi.core import Markup
-from genshi.filters.transform import Transformer
-from genshi.filters.transform import StreamBuffer
-from trac.config import ListOption, Option
-from trac.core import Component, TracError, implements
+import os
+import re
+import sqlite3
+import threading
+import time
+from copy import deepcopy
+from functools import partial
+
+from trac import __version__ as trac_version
+from trac.config import BoolOption, ChoiceOption, IntOption, ListOption, \
+                        Option
+from trac.cache import cached, key_to_id
+from trac.core import Component, implements
+from trac.env import IEnvironmentSetupParticipant
+from trac.mimeview.api import Mimeview
 from trac.perm import IPermissionPolicy, IPermissionRequestor
 from trac.ticket import model
-from trac.ticket.model import Ticket
-from trac.ticket.api import ITicketManipulator
+from trac.ticket.api import ITicketChangeListener, ITicketManipulator, \
+                           TicketSystem
+from trac.ticket.query import Query, QueryModule
+from trac.ticket.report import ReportModule
+from trac.util.text import exception_to_unicode
 from trac.web.api import IRequestFilter, ITemplateStreamFilter
-from trac.web.chrome import ITemplateProvider
+from trac.web.chrome import Chrome, ITemplateProvider, add_script, \
+                            add_script_data, add_warning
+
+from .assets import BlackMagicAssetsModule, tooltip_bundle
+from .audit import DISABLED, DENIED, HIDDEN, REJECTED, DecisionLog
+from .cache import LRUCache, RequestMemo, SharedTicketTypes
+from .export import ExportRedactor
+from .rules import ONDENIAL_HIDE, ColumnPlan, RuleTable
+from .stats import PerformanceStats
+
+try:
+    from trac.ticket.api import translation_deactivated
+except ImportError:
+    # Trac 1.0 heads the query exports with the field names
+    translation_deactivated = None
+
+_MISSING = object()
+
+# Trac renders its own templates with Jinja2, out of reach of stream filters
+_JINJA2_TEMPLATES = tuple(int(v) for v in
+                          re.findall(r'\d+', trac_version)[:2]) >= (1, 3)
 
 
 class BlackMagicTicketTweaks(Component):
     implements(ITemplateStreamFilter, ITemplateProvider, IPermissionRequestor,
-               ITicketManipulator, IPermissionPolicy, IRequestFilter)
+               ITicketManipulator, IPermissionPolicy, IRequestFilter,
+               ITicketChangeListener, IEnvironmentSetupParticipant)
 
     gray_disabled = Option('blackmagic', 'gray_disabled', '', """
         If not set, disabled items will have a label with strike-through font.
@@ -37,189 +70,615 @@ class BlackMagicTicketTweaks(Component):
         `tracopt.perm.config_perm_provider.ExtraPermissionsProvider` component,
         see TracPermissions#CreatingNewPrivileges)""")
 
+    ticket_type_cache_size = IntOption('blackmagic', 'ticket_type_cache_size',
+                                       10000, """
+        Maximum number of ticket id to ticket type mappings kept in memory
+        for the `ticket_type.*` permission checks. Set to `0` to disable the
+        cache.""")
+
+    ticket_type_prefetch = IntOption('blackmagic', 'ticket_type_prefetch', 100,
+                                     """
+        When the type of a ticket isn't cached, also load the types of the
+        tickets with neighbouring ids, in blocks of this size, so that reports,
+        queries and the timeline don't cost one query per row.""")
+
+    shared_cache = BoolOption('blackmagic', 'shared_cache', False, """
+        Also keep the ticket types in `db/blackmagic-cache.db` in the
+        environment, shared by all the processes serving it, so that a
+        ticket type read by one process doesn't have to be read again by
+        the others, nor by a new process. The types are stored along with
+        the generations Trac records for the changes of ticket types, and
+        only used for the same generations.""")
+
+    stats_log_interval = IntOption('blackmagic', 'stats_log_interval', 0, """
+        Number of seconds between two summary lines of the plugin performance
+        counters in the log, `0` to disable them. The counters are always
+        available as JSON at `/blackmagic/stats` to `TRAC_ADMIN` users.""")
+
+    render_plan_cache_size = IntOption('blackmagic', 'render_plan_cache_size',
+                                       64, """
+        Maximum number of ticket page render plans kept in memory. A plan
+        holds the field decisions taken for one set of held permissions, so
+        users sharing a permission profile share a plan. Set to `0` to
+        disable the cache.""")
+
+    allowed_types_cache_size = IntOption('blackmagic',
+                                         'allowed_types_cache_size', 64, """
+        Maximum number of lists of the ticket types a user may see kept in
+        memory. A list is kept for one set of held `ticket_type.*`
+        permissions and one list of ticket types. Set to `0` to disable
+        the cache.""")
+
+    render_mode = ChoiceOption('blackmagic', 'render_mode',
+                               ['auto', 'stream', 'manifest'], """
+        How the field rules are applied to the ticket page. `stream` alters
+        the page on the server with a template stream filter. `manifest`
+        sends the decisions taken for the user as script data and lets a
+        small script apply them in the browser, which is much cheaper to
+        render; hidden fields are still left out of the page, its change
+        history and script data included, and the rules are enforced on
+        submission in both modes. `auto` picks `manifest`
+        with the Jinja2 templates of Trac 1.3 and later, `stream` otherwise.
+        """)
+
+    restrict_query_types = BoolOption('blackmagic', 'restrict_query_types',
+                                      False, """
+        Add a constraint leaving out the ticket types the user may not see,
+        as set by the `ticket_type.*` permissions, to the SQL of the custom
+        queries. The database then only returns tickets the user may see, so
+        the number of tickets and the pages are right. The filters, links
+        and saved queries are left as given. Queries with a `type` filter
+        that can't be combined with the constraint, and reports written in
+        SQL, are still filtered row by row.""")
+
+    audit_log_size = IntOption('blackmagic', 'audit_log_size', 1000, """
+        Number of the latest denials and rejections taken by the plugin kept
+        in memory, with the user, ticket, field and permissions involved.
+        They are available as JSON at `/blackmagic/decisions` to
+        `TRAC_ADMIN` users, and written to the log when its level is
+        `DEBUG`. Set to `0` to only log them.""")
+
+    warmup = BoolOption('blackmagic', 'warmup', False, """
+        Compile the rules, load the ticket types and prepare the page
+        filters and the tooltip bundle as soon as a new worker process opens
+        the environment, rather than while it serves its first requests.""")
+
     def __init__(self):
-        self.enchants = dict()
-        self.extra_permissions = []
-        self.blockedTickets = 0
-        tweaks = self.config.get('blackmagic', 'tweaks', '')
-        self.env.log.debug("Tweaks %s " % tweaks)
-        for e in (x.strip() for x in tweaks.split(',')):
-            self.enchants[e] = dict()
-            self.enchants[e]['permission'] = \
-                self.config.get('blackmagic', '%s.permission' % e, '').upper()
-            self.enchants[e]['disable'] = \
-                self.config.get('blackmagic', '%s.disable' % e, False)
-            self.enchants[e]['hide'] = \
-                self.config.get('blackmagic', '%s.hide' % e, False)
-            self.enchants[e]['label'] = \
-                self.config.get('blackmagic', '%s.label' % e, None)
-            self.enchants[e]['notice'] = \
-                self.config.get('blackmagic', '%s.notice' % e, None)
-            self.enchants[e]['tip'] = \
-                self.config.get('blackmagic', '%s.tip' % e, None)
-            self.enchants[e]['ondenial'] = \
-                self.config.get('blackmagic', '%s.ondenial' % e, 'disable')
-        self.env.log.debug("Enchants %s " % self.enchants)
+        self.stats = PerformanceStats(self.log, self.stats_log_interval)
+        self.decisions = DecisionLog(self.audit_log_size, self.log)
+        self._local = threading.local()
+        self._ticket_types = LRUCache(self.ticket_type_cache_size)
+        self._generation = None
+        self._shared_ticket_types = None
+        if self.shared_cache:
+            self._shared_ticket_types = SharedTicketTypes(
+                os.path.join(self.env.path, 'db', 'blackmagic-cache.db'))
+        self._render_plans = LRUCache(self.render_plan_cache_size)
+        self._allowed_types = LRUCache(self.allowed_types_cache_size)
+        self._numrows_filter = None
+        self._rules = None
+
+    @property
+    def rules(self):
+        """The compiled `[blackmagic]` rule table. Trac opens the environment
+        anew when trac.ini is modified, so it is only built once."""
+        rules = self._rules
+        if rules is None:
+            rules = self._rules = RuleTable(self.config)
+            self.env.log.debug("Enchants %s", rules.enchants)
+        return rules
+
+    @property
+    def client_side(self):
+        """Whether the ticket page rules are applied in the browser."""
+        mode = self.render_mode
+        if mode == 'auto':
+            return _JINJA2_TEMPLATES
+        return mode == 'manifest'
+
+    @property
+    def enchants(self):
+        return self.rules.enchants
+
+    def warm_up(self):
+        """Build ahead of traffic what the first requests would otherwise
+        build: the rule table, the list of ticket types and, when pages are
+        filtered on the server, the Genshi filters, the notice fragments
+        and the tooltip bundle."""
+        start = time.time()
+        rules = self.rules
+        self._ticket_types_enum()
+        tips = any(e.tip for e in rules.enchants.itervalues())
+        if not self.client_side:
+            # loads the Genshi machinery the page filters are built with
+            from .filters import EnchantmentFilter  # noqa: F401
+            self._query_numrows_filter()
+            for e in rules.enchants.itervalues():
+                e.notice_fragment
+        if tips and self.env[BlackMagicAssetsModule] is not None:
+            tooltip_bundle()
+        self.stats.record('warm_up', time.time() - start)
+
+    # IEnvironmentSetupParticipant methods
+
+    def environment_created(self):
+        pass
+
+    def environment_needs_upgrade(self, db=None):
+        # asked by every process opening the environment, before any request
+        if self.warmup:
+            try:
+                self.warm_up()
+            except Exception as e:
+                self.log.warning("BlackMagic warm-up failed: %s",
+                                 exception_to_unicode(e))
+        return False
+
+    def upgrade_environment(self, db=None):
+        pass
 
     # IPermissionPolicy methods
 
     def check_permission(self, action, username, resource, perm):
-        # skip if permission is in ignore_permissions
-        if action in self.permissions or action in self.extra_permissions:
+        # the policy is asked about every check of the site, dismiss the
+        # plugin's own permissions and the resources outside of a ticket
+        # before any bookkeeping
+        if resource is None or action in self.rules.exempt_actions:
             return None
-
-        # look up the resource parentage for a ticket.
-        while resource:
-            if resource.realm == 'ticket':
-                break
+        while resource.realm != 'ticket':
             resource = resource.parent
-        if resource and resource.realm == 'ticket' and resource.id is not None:
-            # return if this req is permitted access to the given ticket ID.
-            try:
-                ticket = Ticket(self.env, resource.id)
-            except TracError:
-                return None  # Ticket doesn't exist
-            # get perm for ticket type
-            ticket_perm = self.config.get('blackmagic', 'ticket_type.%s'
-                                                        % ticket['type'], None)
-            if not ticket_perm:
-                ticket_perm = None
-            self.env.log.debug("Ticket permissions %s type %s "
-                               % (ticket_perm, ticket['type']))
-            if ticket_perm is None:
-                #perm isn't set, return
-                self.env.log.debug("Perm isn't set for ticket type %s"
-                                   % ticket['type'])
+            if resource is None:
                 return None
-            if ticket_perm not in self.permissions:
-                # perm not part of blackmagic perms, adding to extra perms to
-                # prevent recursion crash
-                self.extra_permissions.append(ticket_perm)
-                self.env.log.debug("Perm %s no in permissions " % ticket_perm)
-            # user doesn't have permissions, return false
-            if ticket_perm not in perm:
-                self.env.log.debug("User %s doesn't have permission %s"
-                                   % (username, ticket_perm))
-                self.blockedTickets += 1
-                return False
+        if resource.id is None:
+            return None
+        start = time.time()
+        try:
+            return self._check_permission(action, username, resource, perm)
+        finally:
+            self.stats.record('check_permission', time.time() - start)
+
+    def _check_permission(self, action, username, resource, perm):
+        # return if this req is permitted access to the given ticket ID.
+        ticket_type = self.get_ticket_type(resource.id)
+        if ticket_type is _MISSING:
+            return None  # Ticket doesn't exist
+        # get perm for ticket type
+        ticket_perm = self.rules.ticket_type_permission(ticket_type)
+        if ticket_perm is None:
+            #perm isn't set, return
+            return None
+        # user doesn't have permissions, return false
+        if ticket_perm not in perm:
+            memo = getattr(self._local, 'memo', None)
+            if memo is not None and memo.perm.username == username:
+                if resource.id in memo.blocked:
+                    return False
+                memo.blocked.add(resource.id)
+            self.decisions.record(username, resource.id, 'type', ticket_perm,
+                                  DENIED, ticket_type)
+            return False
         return None
 
+    def get_ticket_type(self, tid):
+        """Return the type of ticket `tid`, loading it together with the types
+        of the neighbouring tickets on a cache miss. Returns `_MISSING` if the
+        ticket doesn't exist."""
+        try:
+            tid = int(tid)
+        except (TypeError, ValueError):
+            return _MISSING
+        # cheap past the first call of a request: Trac reads the generations
+        # of its caches once per request, the memo of the thread may be
+        # left over from the previous one
+        self._sync_ticket_types()
+        ticket_type = self._cached_ticket_type(tid)
+        if ticket_type is not _MISSING:
+            self.stats.incr('ticket_type_cache_hits')
+        else:
+            self.stats.incr('ticket_type_cache_misses')
+            block = self.ticket_type_prefetch
+            if block > 1 and self._ticket_types.maxsize:
+                start = tid - tid % block
+                ids = range(start, start + block)
+            else:
+                ids = [tid]
+            ticket_type = self.prefetch_ticket_types(ids, tid).get(tid,
+                                                                   _MISSING)
+        return ticket_type
+
+    def _cached_ticket_type(self, tid):
+        entry = self._ticket_types.get(tid)
+        if entry is None or entry[0] is not self._generation:
+            return _MISSING
+        return entry[1]
+
+    def prefetch_ticket_types(self, ids, wanted=None):
+        """Load the types of the tickets in `ids` with as few queries as
+        possible and store them in the ticket type cache. Returns a dict
+        mapping the ids of the existing tickets to their type.
+
+        When the shared cache is enabled it is looked up first, and if it
+        knows the `wanted` ticket the other ids aren't looked for in the
+        database.
+        """
+        ids = sorted(set(int(tid) for tid in ids))
+        # a change seen while the types are read moves the generation, they
+        # are then returned but not cached
+        generation = self._generation
+        shared = self._shared_ticket_types
+        if generation is None or generation[2] is None:
+            shared = None
+        types = {}
+        if shared is not None:
+            try:
+                types = shared.get_many(ids, generation[2])
+            except sqlite3.Error as e:
+                self.log.warning("Shared ticket type cache unavailable: %s",
+                                 exception_to_unicode(e))
+                shared = None
+            self.stats.incr('shared_cache_hits', len(types))
+            if wanted in types:
+                ids = []
+            else:
+                ids = [tid for tid in ids if tid not in types]
+        if ids:
+            loaded = {}
+            with self.env.db_query as db:
+                for i in xrange(0, len(ids), 500):
+                    chunk = ids[i:i + 500]
+                    loaded.update(db("SELECT id, type FROM ticket "
+                                     "WHERE id IN (%s)"
+                                     % ','.join(str(tid) for tid in chunk)))
+                    self.stats.incr('ticket_type_queries')
+            self.stats.incr('tickets_loaded', len(loaded))
+            types.update(loaded)
+            if shared is not None and loaded:
+                self._share_ticket_types(loaded.iteritems(), generation)
+        if self._generation is generation:
+            self._ticket_types.update((tid, (generation, ticket_type))
+                                      for tid, ticket_type
+                                      in types.iteritems())
+        return types
+
+    def _prefetch_page_ticket_types(self, ids):
+        ids = [tid for tid in ids
+               if tid and str(tid).isdigit() and
+               self._cached_ticket_type(int(tid)) is _MISSING]
+        if ids:
+            self.prefetch_ticket_types(ids)
+
+    def _share_ticket_types(self, items, generation):
+        try:
+            self._shared_ticket_types.set_many(items, generation[2])
+        except sqlite3.Error as e:
+            self.log.warning("Shared ticket type cache unavailable: %s",
+                             exception_to_unicode(e))
+
+    @cached
+    def _ticket_types_generation(self):
+        """Token replaced in every process, through Trac's cache table,
+        whenever the type of an existing ticket changes."""
+        return object()
+
+    def _shared_generation(self):
+        """Return the generations of `_ticket_types_generation` and of the
+        ticket fields in Trac's cache table, which tag the mappings of the
+        shared cache: they move together with the tokens of all the
+        processes."""
+        ids = [key_to_id(prop.make_key(cls)) for cls, prop in
+               ((self.__class__, self.__class__._ticket_types_generation),
+                (TicketSystem, TicketSystem.fields))]
+        generations = dict(self.env.db_query("""
+            SELECT id, generation FROM cache WHERE id IN (%s,%s)
+            """, ids))
+        return '%s:%s' % tuple(generations.get(id_, -1) for id_ in ids)
+
+    def _sync_ticket_types(self):
+        """Drop the cached mappings when the type of a ticket changed in any
+        process, or when the ticket types themselves changed: renaming a
+        type rewrites the tickets in bulk, unseen by the change listeners,
+        but resets the ticket fields kept by Trac."""
+        token = self._ticket_types_generation
+        fields = TicketSystem(self.env).fields
+        generation = self._generation
+        if generation is None or generation[0] is not token or \
+                generation[1] is not fields:
+            # read before any mapping tagged with it, so that a later change
+            # moves it
+            shared = None
+            if self._shared_ticket_types is not None:
+                shared = self._shared_generation()
+            # the mappings are tagged with this very tuple
+            self._generation = (token, fields, shared)
+            self._ticket_types.clear()
+
+    def _ticket_type_changed(self, tid, ticket_type):
+        # the other processes drop their mappings from their next request on
+        del self._ticket_types_generation
+        self._sync_ticket_types()
+        generation = self._generation
+        if ticket_type is None:
+            self._ticket_types.discard(tid)
+        else:
+            self._ticket_types.set(tid, (generation, ticket_type))
+            if generation[2] is not None:
+                self._share_ticket_types([(tid, ticket_type)], generation)
+
+    # ITicketChangeListener methods
+
+    def ticket_created(self, ticket):
+        self._ticket_types.set(ticket.id, (self._generation, ticket['type']))
+
+    def ticket_changed(self, ticket, comment, author, old_values):
+        if 'type' in old_values:
+            self._ticket_type_changed(ticket.id, ticket['type'])
+
+    def ticket_deleted(self, ticket):
+        self._ticket_type_changed(ticket.id, None)
+
     # IRequestFilter methods
 
     def pre_process_request(self, req, handler):
+        # the policy has no access to the request, the memo is shared with
+        # it through the handling thread
+        self._local.memo = self._request_memo(req)
+        if req.path_info == '/batchmodify' and req.method == 'POST':
+            self._validate_batch_modify(req, handler)
+        if req.args.get('format') in ('csv', 'tab'):
+            self._redact_export(req, handler)
+        if isinstance(handler, QueryModule):
+            restrict = redact = None
+            if self.restrict_query_types:
+                denied = self._denied_ticket_types(req)
+                if denied:
+                    restrict = partial(self._restrict_query, denied=denied)
+            # the query feed is rendered straight from the results, without
+            # a request filter pass
+            enchants = self.rules.enchants
+            if req.args.get('format') == 'rss' and \
+                    ColumnPlan(enchants, ((c, c) for c in enchants)):
+                redact = partial(self._redact_tickets,
+                                 self._request_memo(req))
+            if restrict or redact:
+                handler = _RestrictedQueryModule(handler, restrict, redact)
         return handler
 
+    def _restrict_query(self, req, query, denied):
+        """Leave the `denied` ticket types out of the SQL of `query`, unless
+        one of its clauses can't be combined with them.
+
+        The constraints of the query are only swapped while its SQL is
+        built, so that its filters, links and saved form stay as given.
+        """
+        clauses = deepcopy(query.constraints) or [{}]
+        for clause in clauses:
+            if not self._restrict_clause(clause, denied):
+                return  # left to the policy, row by row
+        query.get_columns()  # chosen from the constraints as given
+        get_sql = query.get_sql
+        def restricted_get_sql(*args, **kwargs):
+            constraints = query.constraints
+            query.constraints = clauses
+            try:
+                return get_sql(*args, **kwargs)
+            finally:
+                query.constraints = constraints
+        query.get_sql = restricted_get_sql
+        self._request_memo(req).restricted_types = frozenset(denied)
+
+    def _denied_ticket_types(self, req):
+        if not self.rules.type_permissions:
+            return []
+        types = self._ticket_types_enum()
+        allowed = set(self.allowed_ticket_types(req, types))
+        return [t for t in types if t not in allowed]
+
+    def _restrict_clause(self, clause, denied):
+        """Add the `denied` ticket types to the `type` constraint of
+        `clause`. Returns `False` if the constraint can't be combined with
+        them."""
+        values = clause.get('type')
+        if not values:
+            clause['type'] = ['!' + t for t in denied]
+            return True
+        if all(v.startswith('!') and v[1:2] not in ('~', '^', '$')
+               for v in values):
+            clause['type'] = values + ['!' + t for t in denied
+                                       if '!' + t not in values]
+            return True
+        if all(v[:1] not in ('!', '~', '^', '$') for v in values):
+            allowed = [v for v in values if v not in denied]
+            if allowed:
+                clause['type'] = allowed
+                return True
+        return False
+
+    def _redact_export(self, req, handler):
+        """Blank the hidden columns of the CSV and TSV exports of reports
+        and queries as they are written."""
+        enchants = self.rules.enchants
+        if not ColumnPlan(enchants, ((c, c) for c in enchants)):
+            return  # no column is ever blanked
+        if isinstance(handler, ReportModule):
+            names = lambda col: col.lower()
+            id_columns = ('id', 'ticket')
+        elif isinstance(handler, QueryModule):
+            # the header of a query export holds the untranslated labels
+            fields = {}
+            if translation_deactivated is not None:
+                with translation_deactivated():
+                    labels = TicketSystem(self.env).get_ticket_field_labels()
+                    fields = dict((unicode(label).encode('utf-8'), name)
+                                  for name, label in labels.iteritems())
+            names = lambda label: fields.get(label, label)
+            id_columns = ('id',)
+        else:
+            return
+        sep = '\t' if req.args.get('format') == 'tab' else ','
+        ExportRedactor(sep, enchants, names, id_columns,
+                       self._request_memo(req).has_permission,
+                       self.stats).install(req)
+
+    def allowed_ticket_types(self, req, types=None):
+        """Return the ticket types among `types`, all of them by default,
+        which the user of `req` may see and create.
+
+        The result only depends on which of the `ticket_type.*` permissions
+        the user holds, so it is cached under that set. The ticket types
+        are part of the key, and the held permissions are worked out again
+        for every request.
+        """
+        if types is None:
+            types = self._ticket_types_enum()
+        rules = self.rules
+        held = self._type_permissions(req)
+        key = (held, tuple(types))
+        allowed = self._allowed_types.get(key)
+        if allowed is None:
+            self.stats.incr('allowed_types_cache_misses')
+            allowed = []
+            for ticket_type in types:
+                ticket_perm = rules.ticket_type_permission(ticket_type)
+                if ticket_perm is None or ticket_perm in held:
+                    allowed.append(ticket_type)
+            self._allowed_types.set(key, allowed)
+        else:
+            self.stats.incr('allowed_types_cache_hits')
+        return list(allowed)
+
+    def _ticket_types_enum(self):
+        # Trac keeps the ticket fields cached until the types change
+        for field in TicketSystem(self.env).fields:
+            if field['name'] == 'type':
+                return field.get('options', [])
+        return []
+
+    def _type_permissions(self, req):
+        """Return the `ticket_type.*` permissions held by the user of
+        `req`."""
+        memo = self._request_memo(req)
+        held = memo.type_permissions
+        if held is None:
+            held = memo.type_permissions = frozenset(
+                perm for perm in set(self.rules.type_permissions.itervalues())
+                if perm in req.perm)
+        return held
+
+    def _request_memo(self, req):
+        memo = getattr(req, '_blackmagic_memo', None)
+        if memo is None:
+            memo = req._blackmagic_memo = RequestMemo(req.perm)
+        return memo
+
     def post_process_request(self, req, template, data, content_type):
+        start = time.time()
+        try:
+            return self._post_process_request(req, template, data,
+                                              content_type)
+        finally:
+            self.stats.record('post_process_request:%s' % template,
+                              time.time() - start)
+
+    def _post_process_request(self, req, template, data, content_type):
+        rules = self.rules
+        # the memo is kept for the checks made while the template renders,
+        # until the next request on this thread replaces it
+        memo = self._request_memo(req)
 
         if template == 'ticket.html' or (template is not None and template.startswith('agilo_ticket_')):
             # remove ticket types user doesn't have permission to access
-            for i, field in enumerate(data['fields']):
+            for field in data['fields']:
                 if field['name'] == 'type':
-                    allowed_types = []
-                    for type in field['options']:
-                        # get perm for ticket type
-                        ticket_perm = self.config.get('blackmagic',
-                                                      'ticket_type.%s' % type)
-                        self.env.log.debug("Checking ticket permissions %s for "
-                                           "type %s" % (ticket_perm, type))
-                        if not ticket_perm or ticket_perm in req.perm:
-                            # user has perm, add to allowed_types
-                            allowed_types.append(type)
-                            self.env.log.debug("User %s has permission %s"
-                                               % (req.authname, ticket_perm))
-                    data['fields'][i]['options'] = allowed_types
-
-        if template == 'report_view.html':
+                    field['options'] = self.allowed_ticket_types(
+                        req, field['options'])
+            if self.client_side and data.get('ticket') is not None:
+                self._add_manifest(req, template, data)
+
+        if template in ('report_view.html', 'report.rss'):
+            self._prefetch_page_ticket_types(
+                t.get('id') or t.get('ticket')
+                for row in data.get('row_groups', []) for l in row
+                if isinstance(l, list) for t in l)
             if 'numrows' in data:
-                data['numrows'] -= self.blockedTickets
-                # reset blocked tickets to 0
-                self.blockedTickets = 0
-            for row in data.get('row_groups', []):
-                for l in row:
-                    if isinstance(l, list):
+                data['numrows'] -= len(memo.blocked)
+            # re-label fields
+            columns = []
+            for g, header_group in enumerate(data.get('header_groups', [])):
+                for i, header in enumerate(header_group):
+                    c = header['col'].lower()
+                    columns.append(((g, i), c))
+                    e = rules.enchants.get(c)
+                    if e is not None and e.label is not None:
+                        header['title'] = e.label
+            # hide hidden fields and fields user doesn't have permission to
+            # and they have ondenial = hide
+            plan = ColumnPlan(rules.enchants, columns)
+            if plan:
+                rows = cells = 0
+                for row in data.get('row_groups', []):
+                    for l in row:
+                        if not isinstance(l, list):
+                            continue
                         for t in l:
                             tid = t.get('id') or t.get('ticket')
                             if not tid:
                                 continue
-                            for cell_group in t.get('cell_groups', []):
-                                for field in cell_group:
-                                    c = field['header']['col'].lower()
-                                    if c in self.enchants:
-                                        e = self.enchants[c]
-                                        # hide hidden fields
-                                        if e['hide']:
-                                            field['value'] = ''
-                                        # hide fields user doesn't have
-                                        # permission to and they have
-                                        # ondenial = hide
-                                        perms = (x.strip() for x in
-                                                 e['permission'].split(','))
-                                        if e['permission'] != '' and \
-                                                e['ondenial'] == 'hide':
-                                            for perm in perms:
-                                                denied = True
-                                                if perm and perm in \
-                                                        req.perm('ticket', tid):
-                                                    denied = False
-                                                if denied:
-                                                    field['value'] = ''
-                                        # re-label fields
-                                        if e['label'] is not None:
-                                            field['header']['title'] = \
-                                                e['label']
+                            cell_groups = t['cell_groups']
+                            redacted = plan.redacted(tid, memo.has_permission)
+                            for g, i in redacted:
+                                cell_groups[g][i]['value'] = ''
+                            if redacted:
+                                rows += 1
+                                cells += len(redacted)
+                self.stats.incr('rows_redacted', rows)
+                self.stats.incr('cells_redacted', cells)
 
         if template == 'query.html':
-            # remove ticket types user doesn't have permission to access
+            self._prefetch_page_ticket_types(t['id']
+                                             for t in data.get('tickets', []))
+            # remove ticket types user doesn't have permission to access,
+            # from the filters and the batch modification form as well
             if 'type' in data['fields']:
-                allowed_types = []
-                for type in data['fields']['type']['options']:
-                    # get perm for ticket type
-                    ticket_perm = self.config.get('blackmagic',
-                                                  'ticket_type.%s' % type)
-                    self.env.log.debug("Ticket permissions %s type %s "
-                                       % (ticket_perm, type))
-                    if not ticket_perm or ticket_perm in req.perm:
-                        # user has perm, add to allowed_types
-                        allowed_types.append(type)
-                        self.env.log.debug("User %s has permission %s"
-                                           % (req.authname, ticket_perm))
+                allowed_types = self.allowed_ticket_types(
+                    req, data['fields']['type']['options'])
                 data['fields']['type']['options'] = allowed_types
+                properties = req.chrome.get('script_data', {}) \
+                                       .get('properties')
+                if properties and 'type' in properties:
+                    properties['type']['options'] = allowed_types
             # remove ticket fields user doesn't have access to
-            for i in range(len(data['tickets'])):
-                ticket = data['tickets'][i]
-                for c in ticket:
-                    if c in self.enchants:
-                        # hide hidden fields
-                        e = self.enchants[c]
-                        if e['hide']:
-                            data['tickets'][i][c] = ''
-                        # hide fields user doesn't have permission to and they
-                        # have ondenial = hide
-                        if e['permission'] != '' and e['ondenial'] == 'hide':
-                            for perm in (x.strip() for x in
-                                         e['permission'].split(',')):
-                                denied = True
-                                if perm and perm in \
-                                        req.perm('ticket', ticket['id']):
-                                    denied = False
-                                if denied:
-                                    data['tickets'][i][c] = ''
+            self._redact_tickets(memo, data['tickets'])
             # headers
-            for i in range(len(data['headers'])):
-                c = data['headers'][i]['name']
-                if c in self.enchants:
-                    # re-label fields
-                    if self.enchants[c]['label'] is not None:
-                        data['headers'][i]['label'] = self.enchants[c]['label']
+            for header in data['headers']:
+                e = rules.enchants.get(header['name'])
+                # re-label fields
+                if e is not None and e.label is not None:
+                    header['label'] = e.label
             # fields
             for c, v in data['fields'].items():
-                if c in self.enchants:
-                    #re-label fields
-                    if self.enchants[c]['label'] is not None:
-                        data['fields'][c]['label'] = self.enchants[c]['label']
+                e = rules.enchants.get(c)
+                #re-label fields
+                if e is not None and e.label is not None:
+                    v['label'] = e.label
 
         return template, data, content_type
 
+    def _redact_tickets(self, memo, tickets):
+        """Blank the hidden fields of the query `tickets`, in place."""
+        plan = ColumnPlan(self.rules.enchants,
+                          ((c, c) for c in tickets[0]) if tickets else ())
+        if plan:
+            rows = cells = 0
+            for ticket in tickets:
+                redacted = plan.redacted(ticket['id'], memo.has_permission)
+                for c in redacted:
+                    ticket[c] = ''
+                if redacted:
+                    rows += 1
+                    cells += len(redacted)
+            self.stats.incr('rows_redacted', rows)
+            self.stats.incr('cells_redacted', cells)
+
     # ITicketManipulator methods
 
     def validate_ticket(self, req, ticket):
@@ -228,51 +687,155 @@ class BlackMagicTicketTweaks(Component):
         Must return a list of `(field, message)` tuples, one for each problem
         detected. `field` can be `None` to indicate an overall problem with the
         ticket. Therefore, a return value of `[]` means everything is OK."""
+        start = time.time()
+        try:
+            return self._validate_ticket(req, ticket)
+        finally:
+            self.stats.record('validate_ticket', time.time() - start)
 
+    def _validate_ticket(self, req, ticket):
         res = []
-        self.env.log.debug('Validating ticket: %s' % ticket.id)
-
-        for e, v in self.enchants.items():
-            editable = True
-            self.env.log.debug('%s' % v)
-            if ticket.values.get(e, None) is not None:
-                if v['disable'] or v['hide']:
-                    editable = False
-                elif v['permission'] != '':
-                    editable = False
-                    for perm in (x.strip() for x in v['permission'].split(',')):
-                        self.env.log.debug("Checking permission %s" % perm)
-                        # user has permission no denied
-                        if perm and perm in req.perm(ticket.resource):
-                            self.env.log.debug("Has %s permission" % perm)
-                            editable = True
+        rules = self.rules
+        memo = self._request_memo(req)
+        original = None
+        self.env.log.debug("Validating ticket: %s", ticket.id)
+
+        for e, v in rules.enchants.items():
+            if ticket.values.get(e, None) is None or \
+                    self._is_editable(v, memo, ticket.id):
+                continue
 
             # field is disabled or hidden, cannot be modified by user
-            if not editable:
-                self.env.log.debug("%s disabled or hidden " % e)
-                # get default ticket state or original ticket if being modified
-                ot = model.Ticket(self.env, ticket.id)
-                original = ot.values.get('%s' % e, None)
-                new = ticket.values.get('%s' % e, None)
-                self.env.log.debug('OT: %s' % original)
-                self.env.log.debug('NEW: %s' % new)
-                # field has been modified throw error
-                if new != original:
-                    res.append(('%s' % e, 'Access denied to modifying %s' % e))
-                    self.env.log.debug('Denied access to: %s' % e)
+            # get default ticket state or original ticket if being modified
+            if original is None:
+                original = self._original_values(ticket)
+            new = ticket.values.get(e, None)
+            # field has been modified throw error
+            if new != original.get(e, None):
+                res.append(('%s' % e, 'Access denied to modifying %s' % e))
+                self.decisions.record(req.authname, ticket.id, e,
+                                      v.permissions, REJECTED)
 
         # check if user has perm to create ticket type
-        ticket_type = 'ticket_type.%s' % ticket['type']
-        ticket_perm = self.config.get('blackmagic', ticket_type, None)
-        if not ticket_perm:
-            ticket_perm = None
-        if ticket_perm is not None and ticket_perm not in req.perm:
-            self.env.log.debug("Ticket validation failed type %s permission %s"
-                               % (ticket['type'], ticket_perm))
+        ticket_perm = rules.ticket_type_permission(ticket['type'])
+        if ticket_perm is not None and \
+                ticket_perm not in self._type_permissions(req):
             res.append(('type', "Access denied to ticket type %s"
                                 % ticket['type']))
+            self.decisions.record(req.authname, ticket.id, 'type',
+                                  ticket_perm, REJECTED, ticket['type'])
         return res
 
+    def _is_editable(self, e, memo, tid):
+        """Return whether the field of enchantment `e` may be modified on
+        ticket `tid`."""
+        if e.disable or e.hide:
+            return False
+        if not e.permissions:
+            return True
+        for perm in e.permissions:
+            # user has permission no denied
+            if memo.has_permission(perm, tid):
+                return True
+        return False
+
+    def _original_values(self, ticket):
+        """Return the field values of `ticket` before it was populated from
+        the user input, or the defaults for a new ticket."""
+        if not ticket.exists:
+            return model.Ticket(self.env).values
+        old = getattr(ticket, '_old', None)
+        if old is not None:
+            # the ticket remembers the values of the fields set since it
+            # was loaded
+            values = dict(ticket.values)
+            values.update(old)
+            return values
+        self.stats.incr('tickets_loaded')
+        return model.Ticket(self.env, ticket.id).values
+
+    def _validate_batch_modify(self, req, handler):
+        """Reject a batch modification of fields the user may not modify on
+        some of the selected tickets, before any of them is saved. The
+        original values of all the selected tickets are loaded at once."""
+        rules = self.rules
+        changes = {}
+        for field in rules.enchants:
+            if 'batchmod_value_' + field in req.args:
+                changes[field] = \
+                    lambda old, new=req.args.get('batchmod_value_' + field): \
+                    new
+            mode = req.args.get('batchmod_mode_' + field)
+            if mode and hasattr(handler, '_change_list'):
+                changes[field] = \
+                    lambda old, new=req.args.get('batchmod_primary_' + field,
+                                                 ''), \
+                    new2=req.args.get('batchmod_secondary_' + field, ''), \
+                    mode=mode: handler._change_list(old, new, new2, mode)
+            elif mode:
+                changes[field] = lambda old: None
+
+        errors = []
+        new_type = req.args.get('batchmod_value_type')
+        if new_type is not None:
+            # check if user has perm to set the ticket type
+            ticket_perm = rules.ticket_type_permission(new_type)
+            if ticket_perm is not None and \
+                    ticket_perm not in self._type_permissions(req):
+                errors.append("Access denied to ticket type %s" % new_type)
+                self.decisions.record(req.authname, None, 'type', ticket_perm,
+                                      REJECTED, new_type)
+
+        ids = [int(tid) for tid in
+               req.args.get('selected_tickets', '').split(',')
+               if tid.strip().isdigit()]
+        if changes and ids:
+            memo = self._request_memo(req)
+            originals = self._load_ticket_values(ids, changes.keys())
+            for tid in ids:
+                values = originals.get(tid, {})
+                for field, change in sorted(changes.items()):
+                    if self._is_editable(rules.enchants[field], memo, tid):
+                        continue
+                    old = values.get(field) or ''
+                    if (change(old) or '') != old:
+                        errors.append("Access denied to modifying %s of "
+                                      "ticket #%s" % (field, tid))
+                        self.decisions.record(
+                            req.authname, tid, field,
+                            rules.enchants[field].permissions, REJECTED)
+        if errors:
+            add_warning(req, "The changes could not be saved: %s"
+                             % ', '.join(errors))
+            req.redirect(req.args.get('query_href') or req.href.query())
+
+    def _load_ticket_values(self, ids, fields):
+        """Return the values of `fields` for the tickets in `ids`, as a dict
+        of dicts keyed by ticket id, using one query for the standard fields
+        and one for the custom fields."""
+        custom = set(f['name'] for f in TicketSystem(self.env).custom_fields)
+        std_fields = [f for f in fields if f not in custom]
+        custom_fields = [f for f in fields if f in custom]
+        values = dict((tid, {}) for tid in ids)
+        with self.env.db_query as db:
+            for i in xrange(0, len(ids), 500):
+                id_list = ','.join(str(tid) for tid in ids[i:i + 500])
+                if std_fields:
+                    for row in db("SELECT id,%s FROM ticket WHERE id IN (%s)"
+                                  % (','.join(db.quote(f) for f in std_fields),
+                                     id_list)):
+                        values[row[0]].update(zip(std_fields, row[1:]))
+                if custom_fields:
+                    for tid, name, value in db("""
+                            SELECT ticket,name,value FROM ticket_custom
+                            WHERE ticket IN (%s) AND name IN (%s)
+                            """ % (id_list, ','.join(['%s'] *
+                                                     len(custom_fields))),
+                            custom_fields):
+                        values[tid][name] = value
+        self.stats.incr('tickets_loaded', len(ids))
+        return values
+
     # IPermissionRequestor methods
 
     def get_permission_actions(self):
@@ -281,135 +844,206 @@ class BlackMagicTicketTweaks(Component):
     # ITemplateStreamFilter methods
 
     def filter_stream(self, req, method, filename, stream, data):
+        # only accounts for setting up the filters, the stream itself is
+        # walked while the template is rendered
+        start = time.time()
+        try:
+            return self._filter_stream(req, method, filename, stream, data)
+        finally:
+            self.stats.record('filter_stream', time.time() - start)
+
+    def _filter_stream(self, req, method, filename, stream, data):
         # remove matches from custom queries due to the fact ticket permissions
         # are checked after this stream is manipulated so the count cannot be
-        # updated.
-        if filename == 'query.html':
-            stream |= Transformer('//div[@class="query"]/h1'
-                                  '/span[@class="numrows"]/text()').replace('')
+        # updated, unless the query itself left the denied types out.
+        if filename == 'query.html' and \
+                not self._request_memo(req).restricted_types:
+            stream |= self._query_numrows_filter()
 
         if filename == 'ticket.html' or (filename is not None and filename.startswith('agilo_ticket_')):
-            for field, e in self.enchants.items():
-                disabled = e['disable']
-                hidden = e['hide']
-                # permissions are set for field
-                if e['permission'] != '' and not hidden and not \
-                        (disabled or disabled and e['ondenial'] == 'hide'):
-                    self.env.log.debug("Permissions %s" % e['permission'])
-                    # default set to denied
-                    denied = True
-                    # iterate through permissions
-                    for perm in (x.strip() for x in e['permission'].split(',')):
-                        self.env.log.debug("Checking permission %s" % perm)
-                        # user has permission no denied
-                        if perm and \
-                                perm in req.perm(data.get('ticket').resource):
-                            self.env.log.debug("Has %s permission" % perm)
-                            denied = False
-                    # if denied is true hide/disable depending on denial setting
-                    if denied:
-                        denial = self.config.get('blackmagic',
-                                                 '%s.ondenial' % field, None)
-                        if denial:
-                            if denial == 'disable':
-                                disabled = True
-                            elif denial == 'hide':
-                                hidden = True
-                            else:
-                                disabled = True
-                        else:
-                            disabled = True
-
-                # hide fields
-                if hidden:
-                    # replace th and td in previews with empty tags
-                    stream |= Transformer('//th[@id="h_%s"]' % field) \
-                        .replace(tag.th(' '))
-                    stream |= Transformer('//td[@headers="h_%s"]' % field)\
-                        .replace(tag.td(' '))
-                    # replace labels and fields with blank space
-                    stream |= Transformer('//label[@for="field-%s"]' % field) \
-                        .replace(' ')
-                    stream |= Transformer('//*[@id="field-%s"]' % field). \
-                        replace(' ')
-
-                # change label
-                if e['label'] is not None:
-                    stream |= Transformer(
-                        '//th[@id="h_%s"]/text()' % field) \
-                        .replace(e['label'] + ":")
-                    stream |= Transformer(
-                        '//label[@for="field-%s"]/text()' % field). \
-                        replace(e['label'] + ":")
-
-                if disabled:
-                    sbuffer = StreamBuffer()
-                    # copy input to buffer then disable original
-                    stream |= Transformer(
-                        '//*[@id="field-%s" and (@checked) '
-                        'and @type="checkbox"]'
-                        % field).copy(sbuffer).after(sbuffer).attr('disabled',
-                                                                   'disabled')
-                    # change new element to hidden field instead of checkbox
-                    # and remove check
-                    stream |= Transformer(
-                        '//*[@id="field-%s" and not (@disabled) and '
-                        '(@checked) and @type="checkbox"]' % field) \
-                        .attr('type', 'hidden').attr('checked', None) \
-                        .attr('id', None)
-                    # disable non-check boxes / unchecked check boxes
-                    stream |= Transformer(
-                        '//*[@id="field-%s" and not (@checked)]' % field) \
-                        .attr('disabled', 'disabled')
-
-                    if not self.gray_disabled:
-                        # cut label content into buffer then append it into the
-                        # label with a strike tag around it
-                        stream |= Transformer(
-                            '//label[@for="field-%s"]/text()' % field) \
-                            .cut(sbuffer).end() \
-                            .select('//label[@for="field-%s"]/' % field) \
-                            .append(tag.strike(sbuffer))
-                    else:
-                        #cut label and replace with coloured span
-                        stream |= Transformer(
-                            '//label[@for="field-%s"]/text()' % field) \
-                            .cut(sbuffer).end() \
-                            .select('//label[@for="field-%s"]/' % field) \
-                            .append(
-                                tag.span(sbuffer, style='color:%s'
-                                                        % self.gray_disabled)
-                            )
-
-                if self.config.get('blackmagic', '%s.notice' % field, None):
-                    stream |= Transformer('//*[@id="field-%s"]' % field).after(
-                        tag.br() + tag.small()(
-                            tag.em()(
-                                Markup(self.config.get('blackmagic',
-                                                       '%s.notice' % field))
-                            )
-                        )
-                    )
-
-                tip = self.config.get('blackmagic', '%s.tip' % field, None)
-                if tip:
-                    stream |= Transformer('//div[@id="banner"]').before(
-                        tag.script(type='text/javascript',
-                                   src=req.href.chrome('blackmagic', 'js',
-                                                       'wz_tooltip.js'))()
-                    )
-
-                    stream |= Transformer('//*[@id="field-%s"]' % field) \
-                        .attr('onmouseover',
-                              "Tip('%s')" % tip.replace(r"'", r"\'"))
+            if self.client_side:
+                return stream
+            # hide, re-label, disable and annotate the fields in a single pass
+            stream |= self._render_plan(req, filename, data.get('ticket').id,
+                                        self._build_filter)
 
         return stream
 
+    def _render_plan(self, req, template, tid, build):
+        """Return what `build` makes of the field decisions of ticket `tid`
+        for the user of `req`.
+
+        The decisions only depend on which of the permissions named by the
+        rules the user holds, so the result is cached under that set along
+        with the template.
+        """
+        rules = self.rules
+        memo = self._request_memo(req)
+        held = frozenset(perm for perm in rules.field_permissions
+                         if memo.has_permission(perm, tid))
+        for e in rules.guarded_fields:
+            if held.isdisjoint(e.permissions):
+                self.decisions.record(req.authname, tid, e.field,
+                                      e.permissions,
+                                      HIDDEN if e.ondenial == ONDENIAL_HIDE
+                                      else DISABLED)
+        key = (template, build.__name__, held, req.href())
+        plan = self._render_plans.get(key, _MISSING)
+        if plan is _MISSING:
+            self.stats.incr('render_plan_cache_misses')
+            self.env.log.debug("Building %s render plan for permissions %s",
+                               template, sorted(held))
+            plan = build(req, rules.field_decisions(held))
+            self._render_plans.set(key, plan)
+        else:
+            self.stats.incr('render_plan_cache_hits')
+        return plan
+
+    def _query_numrows_filter(self):
+        # the transformer holds no state of its own, it is compiled once
+        if self._numrows_filter is None:
+            from genshi.filters.transform import Transformer
+            self._numrows_filter = Transformer(
+                '//div[@class="query"]/h1/span[@class="numrows"]/text()') \
+                .replace('')
+        return self._numrows_filter
+
+    def _build_filter(self, req, decisions):
+        from .filters import EnchantmentFilter
+        return EnchantmentFilter(decisions, self.rules.gray_disabled,
+                                 self._tooltip_script(req))
+
+    def _build_manifest(self, req, decisions):
+        fields = {}
+        tips = False
+        for d in decisions:
+            e = d.enchant
+            manifest = {}
+            if d.hidden:
+                manifest['hide'] = True
+            else:
+                if d.disabled:
+                    manifest['disable'] = True
+                if e.label is not None:
+                    manifest['label'] = e.label
+                if e.notice:
+                    manifest['notice'] = e.notice
+                if e.tip:
+                    manifest['tip'] = e.tip
+                    tips = True
+            if manifest:
+                fields[e.field] = manifest
+        if not fields:
+            return None
+        manifest = {'fields': fields,
+                    'gray_disabled': self.rules.gray_disabled}
+        if tips:
+            assets = self.env[BlackMagicAssetsModule]
+            if assets is not None:
+                manifest['tooltip'] = assets.tooltip_href(req)
+                manifest['tooltip_lazy'] = assets.tooltip_lazy
+            else:
+                manifest['tooltip'] = req.href.chrome('blackmagic', 'js',
+                                                      'wz_tooltip.js')
+        return manifest
+
+    def _add_manifest(self, req, template, data):
+        """Publish the field decisions of the ticket page as the `blackmagic`
+        script data, to be applied by `blackmagic.js` in the browser."""
+        manifest = self._render_plan(req, template, data['ticket'].id,
+                                     self._build_manifest)
+        if manifest is None:
+            return
+        # hidden fields don't even reach the page, be it in the ticket box,
+        # the change history or the script data of Trac
+        hidden = set(name for name, d in manifest['fields'].iteritems()
+                     if d.get('hide'))
+        for field in data.get('fields') or ():
+            if field['name'] in hidden:
+                field['skip'] = True
+        for change in data.get('changes') or ():
+            if hidden.intersection(change.get('fields') or ()):
+                change['fields'] = dict((name, f) for name, f
+                                        in change['fields'].iteritems()
+                                        if name not in hidden)
+        script_data = req.chrome.get('script_data', {})
+        old_values = script_data.get('old_values')
+        if old_values:
+            script_data['old_values'] = dict(
+                (name, value) for name, value in old_values.iteritems()
+                if name not in hidden)
+        add_script_data(req, blackmagic=manifest)
+        add_script(req, 'blackmagic/js/blackmagic.js')
+
+    def _tooltip_script(self, req):
+        assets = self.env[BlackMagicAssetsModule]
+        if assets is None:
+            # the bundle isn't served, fall back to the plain library
+            from genshi.builder import tag
+            return tag.script(type='text/javascript',
+                              src=req.href.chrome('blackmagic', 'js',
+                                                  'wz_tooltip.js'))
+        return assets.tooltip_script(req)
+
     # ITemplateProvider methods
 
     def get_htdocs_dirs(self):
-        from pkg_resources import resource_filename
-        return [('blackmagic', resource_filename(__name__, 'htdocs'))]
+        return [('blackmagic', os.path.join(os.path.dirname(__file__),
+                                            'htdocs'))]
 
     def get_templates_dirs(self):
         return []
+
+
+class _RestrictedQueryModule(object):
+    """Stands for the query module during one request and lets `restrict`
+    alter the query before it is executed, and `redact` blank the results
+    of the query as they are returned. Either can be `None`.
+
+    This follows `QueryModule.process_request` as of Trac 1.0 to 1.4, which
+    builds the query and then either sends it converted (CSV, TSV, RSS) or
+    hands it to `display_html`. The conversion is deferred to the latter, so
+    that both see the altered query.
+    """
+
+    def __init__(self, module, restrict, redact=None):
+        self._module = module
+        self._restrict = restrict
+        self._redact = redact
+        self._format = None
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+    def process_request(self, req):
+        # the navigation and scripts of the page are set up for the module
+        req.callbacks['chrome'] = partial(Chrome(self.env).prepare_request,
+                                          handler=self._module)
+        self._format = req.args.get('format')
+        if self._format:
+            del req.args['format']
+        return QueryModule.process_request.im_func(self, req)
+
+    def display_html(self, req, query):
+        if self._format in ('csv', 'tab') and 'max' not in req.args and \
+                query.max == query.items_per_page:
+            # built without the format, the query was given the page size,
+            # while Trac only limits exports to an explicit maximum
+            query = Query(self.env, query.id, query.constraints, query.cols,
+                          query.order, query.desc, query.group,
+                          query.groupdesc, rows=query.rows, page=query.page,
+                          max=0)
+        if self._restrict:
+            self._restrict(req, query)
+        if self._redact:
+            execute = query.execute
+            def redacted_execute(*args, **kwargs):
+                tickets = execute(*args, **kwargs)
+                self._redact(tickets)
+                return tickets
+            query.execute = redacted_execute
+        if self._format:
+            filename = 'query' if self._format != 'rss' else None
+            Mimeview(self.env).send_converted(req, 'trac.ticket.Query', query,
+                                              self._format, filename=filename)
+        return self._module.display_html(req, query)
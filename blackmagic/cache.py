@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2008 Stephen Hansen <shansen@advpubtech.com>
+# Copyright (C) 2009 Rowan Wookey <support@obsidianproject.co.uk>
+# Copyright (C) 2008-2009 www.obsidianproject.co.uk
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import sqlite3
+from collections import OrderedDict
+from threading import Lock, RLock
+
+
+class LRUCache(object):
+    """Thread-safe mapping holding at most `maxsize` entries, evicting the
+    least recently used entry first. A `maxsize` of 0 disables caching."""
+
+    def __init__(self, maxsize):
+        self.maxsize = max(0, int(maxsize))
+        self._data = OrderedDict()
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def update(self, items):
+        for key, value in items:
+            self.set(key, value)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RequestMemo(object):
+    """Permission decisions taken while processing a single request, along
+    with the ids of the tickets the policy blocked for it, the ticket type
+    permissions held by its user and the ticket types left out of its query,
+    if any."""
+
+    __slots__ = ('perm', 'decisions', 'blocked', 'type_permissions',
+                 'restricted_types')
+
+    def __init__(self, perm):
+        self.perm = perm
+        self.decisions = {}
+        self.blocked = set()
+        self.type_permissions = None
+        self.restricted_types = None
+
+    def has_permission(self, action, tid):
+        """Return whether `action` is granted on ticket `tid`, asking the
+        permission system only once per `(action, tid)` pair."""
+        key = (action, tid)
+        try:
+            return self.decisions[key]
+        except KeyError:
+            allowed = self.decisions[key] = action in self.perm('ticket', tid)
+            return allowed
+
+
+
+class SharedTicketTypes(object):
+    """Ticket id to ticket type mappings kept in a SQLite file shared by all
+    the processes serving an environment.
+
+    Every mapping is stored with the generation it was read at, and only
+    returned for that same generation. The file is opened, and its schema
+    created, once per process; the connection is shared by the threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._cnx = None
+        self._lock = Lock()
+
+    def _connection(self):
+        if self._cnx is None:
+            cnx = sqlite3.connect(self.path, timeout=10,
+                                  isolation_level=None,
+                                  check_same_thread=False)
+            cnx.execute("PRAGMA journal_mode=WAL")
+            cnx.execute("CREATE TABLE IF NOT EXISTS ticket_type "
+                        "(id INTEGER PRIMARY KEY, type TEXT, "
+                        "generation TEXT)")
+            self._cnx = cnx
+        return self._cnx
+
+    def get_many(self, ids, generation):
+        """Return a dict mapping the ids of `ids` known to the cache at
+        `generation` to their ticket type."""
+        ids = [int(tid) for tid in ids]
+        types = {}
+        with self._lock:
+            cnx = self._connection()
+            for i in xrange(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                types.update(cnx.execute("SELECT id, type FROM ticket_type "
+                                         "WHERE generation=? AND id IN (%s)"
+                                         % ','.join('?' * len(chunk)),
+                                         [generation] + chunk))
+        return types
+
+    def set_many(self, items, generation):
+        """Store the `(id, type)` pairs of `items`, as read at
+        `generation`."""
+        with self._lock:
+            cnx = self._connection()
+            cnx.execute("BEGIN")
+            try:
+                cnx.executemany("INSERT OR REPLACE INTO ticket_type "
+                                "VALUES (?, ?, ?)",
+                                ((tid, ticket_type, generation)
+                                 for tid, ticket_type in items))
+            except:
+                cnx.execute("ROLLBACK")
+                raise
+            cnx.execute("COMMIT")
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2008 Stephen Hansen <shansen@advpubtech.com>
+# Copyright (C) 2009 Rowan Wookey <support@obsidianproject.co.uk>
+# Copyright (C) 2008-2009 www.obsidianproject.co.uk
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import csv
+from cStringIO import StringIO
+
+from .rules import ColumnPlan
+
+_BOM = '\xef\xbb\xbf'
+
+
+def _lines(chunks, pending):
+    """Split `chunks` into lines, keeping their terminator. An incomplete
+    last line is left in `pending[0]` for the next call."""
+    for chunk in chunks:
+        for line in StringIO(chunk):
+            if pending[0]:
+                line = pending[0] + line
+                pending[0] = ''
+            if line.endswith('\n'):
+                yield line
+            else:
+                pending[0] = line
+
+
+class ExportRedactor(object):
+    """Blanks the enchanted columns of a CSV or TSV export while it is
+    written, one row at a time.
+
+    The columns are identified from the header row; `names` maps its cells
+    to field names. Rows are then redacted through a `ColumnPlan`, the
+    ticket being read from the first of the `id_columns` present.
+    """
+
+    def __init__(self, sep, enchants, names, id_columns, has_permission,
+                 stats=None):
+        self.sep = sep
+        self.enchants = enchants
+        self.names = names
+        self.id_columns = id_columns
+        self.has_permission = has_permission
+        self.stats = stats
+        self.plan = None
+        self.id_index = None
+        self._pending = ['']
+        self._first = True
+        self._bom = ''
+
+    def install(self, req):
+        """Redact what is written to `req` from now on. The length of the
+        export changes, so a `Content-Length` header is dropped."""
+        send_header = req.send_header
+        write = req.write
+
+        def redacting_send_header(name, value):
+            if name.lower() != 'content-length':
+                send_header(name, value)
+
+        def redacting_write(data):
+            if isinstance(data, basestring):
+                data = [data]
+            write(self.redact(data))
+
+        req.send_header = redacting_send_header
+        req.write = redacting_write
+
+    def redact(self, chunks):
+        """Generate the redacted export from the `chunks` of the original
+        one."""
+        out = StringIO()
+        writer = csv.writer(out, delimiter=self.sep,
+                            quoting=csv.QUOTE_MINIMAL)
+        rows = cells = 0
+        for row in csv.reader(self._strip_bom(_lines(chunks, self._pending)),
+                              delimiter=self.sep):
+            if self.plan is None:
+                self._read_header(row)
+                out.write(self._bom)
+            elif self.plan:
+                tid = None
+                if self.id_index is not None and self.id_index < len(row) \
+                        and row[self.id_index].isdigit():
+                    tid = int(row[self.id_index])
+                redacted = self.plan.redacted(tid, self.has_permission)
+                for i in redacted:
+                    if i < len(row):
+                        row[i] = ''
+                if redacted:
+                    rows += 1
+                    cells += len(redacted)
+            writer.writerow(row)
+            yield out.getvalue()
+            out.truncate(0)
+        if self.stats:
+            self.stats.incr('export_rows_redacted', rows)
+            self.stats.incr('export_cells_redacted', cells)
+
+    def _strip_bom(self, lines):
+        # the byte order mark is written back in front of the header
+        for line in lines:
+            if self._first:
+                self._first = False
+                if line.startswith(_BOM):
+                    self._bom = _BOM
+                    line = line[len(_BOM):]
+            yield line
+
+    def _read_header(self, row):
+        names = [self.names(cell) for cell in row]
+        self.plan = ColumnPlan(self.enchants, enumerate(names))
+        for name in self.id_columns:
+            if name in names:
+                self.id_index = names.index(name)
+                break
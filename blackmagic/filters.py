@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2008 Stephen Hansen <shansen@advpubtech.com>
+# Copyright (C) 2009 Rowan Wookey <support@obsidianproject.co.uk>
+# Copyright (C) 2008-2009 www.obsidianproject.co.uk
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+from genshi.builder import tag
+from genshi.core import END, START, TEXT, QName, Stream
+
+_DISABLED = [(QName('disabled'), 'disabled')]
+_HIDDEN_TYPE = [(QName('type'), 'hidden')]
+_CHECKED = [QName('checked')]
+_ID = [QName('id')]
+_RELABELED = object()
+
+
+class EnchantmentFilter(object):
+    """Genshi stream filter applying the field decisions of a ticket page.
+
+    The stream is walked once; elements are matched through dict lookups on
+    their `id`, `for` and `headers` attributes instead of one XPath pass per
+    field and operation. The output is the same as the one of the equivalent
+    `Transformer` chain. The filter holds no per-page state, so it can be
+    reused for every page sharing the same decisions.
+    """
+
+    def __init__(self, decisions, gray_disabled, tip_script):
+        self.gray_disabled = gray_disabled
+        self.tip_script = tip_script
+        self.th_ids = {}
+        self.td_headers = {}
+        self.label_fors = {}
+        self.field_ids = {}
+        self.tips = False
+        for d in decisions:
+            e = d.enchant
+            if d.hidden or e.label is not None:
+                self.th_ids['h_%s' % e.field] = d
+            if d.hidden:
+                self.td_headers['h_%s' % e.field] = d
+            if d.hidden or d.disabled or e.label is not None:
+                self.label_fors['field-%s' % e.field] = d
+            if d.hidden or d.disabled or e.notice_fragment or e.tip_script:
+                self.field_ids['field-%s' % e.field] = d
+            if e.tip_script:
+                self.tips = True
+
+    def __call__(self, stream):
+        return Stream(self._filter(iter(stream), self.tips))
+
+    def _filter(self, events, tips=False):
+        for event in events:
+            kind, data, pos = event
+            if kind is START:
+                handler = self._match(*data)
+                if handler is not None:
+                    subtree = self._subtree(event, events)
+                    for subevent in handler[0](handler[1], subtree):
+                        yield subevent
+                    continue
+                if tips and data[0].localname == 'div' and \
+                        data[1].get('id') == 'banner':
+                    # the tooltip library is loaded once for all the tips
+                    tips = False
+                    for subevent in self.tip_script.generate():
+                        yield subevent
+            yield event
+
+    def _match(self, qname, attrs):
+        name = qname.localname
+        if name == 'th':
+            d = self.th_ids.get(attrs.get('id'))
+            if d is not None:
+                return self._header, d
+        elif name == 'td':
+            d = self.td_headers.get(attrs.get('headers'))
+            if d is not None:
+                return self._cell, d
+        elif name == 'label':
+            d = self.label_fors.get(attrs.get('for'))
+            if d is not None:
+                return self._label, d
+        d = self.field_ids.get(attrs.get('id'))
+        if d is not None:
+            return self._field, d
+        return None
+
+    def _subtree(self, start, events):
+        """Return the events of the element opened by `start`."""
+        subtree = [start]
+        depth = 1
+        for event in events:
+            subtree.append(event)
+            if event[0] is START:
+                depth += 1
+            elif event[0] is END:
+                depth -= 1
+                if not depth:
+                    break
+        return subtree
+
+    def _children(self, subtree):
+        return list(self._filter(iter(subtree[1:-1])))
+
+    def _relabel(self, d, children):
+        # replace every run of direct text children by the new label
+        label = d.enchant.label + ':'
+        result = []
+        depth = 0
+        for event in children:
+            if event[0] is TEXT and not depth:
+                if not result or result[-1] is not _RELABELED:
+                    result.append(_RELABELED)
+                continue
+            if event[0] is START:
+                depth += 1
+            elif event[0] is END:
+                depth -= 1
+            result.append(event)
+        return [(TEXT, label, (None, -1, -1)) if event is _RELABELED
+                else event for event in result]
+
+    def _header(self, d, subtree):
+        if d.hidden:
+            return tag.th(' ').generate()
+        return [subtree[0]] + self._relabel(d, self._children(subtree)) + \
+            [subtree[-1]]
+
+    def _cell(self, d, subtree):
+        return tag.td(' ').generate()
+
+    def _label(self, d, subtree):
+        if d.hidden:
+            return [(TEXT, ' ', (None, -1, -1))]
+        children = self._children(subtree)
+        if d.enchant.label is not None:
+            children = self._relabel(d, children)
+        if d.disabled:
+            # move the last run of direct text children into a strike-through
+            # or grayed out element
+            result = []
+            text = []
+            depth = 0
+            previous = None
+            for event in children:
+                if event[0] is TEXT and not depth:
+                    if previous is not TEXT:
+                        text = []
+                    text.append(event)
+                    previous = TEXT
+                    continue
+                if event[0] is START:
+                    depth += 1
+                elif event[0] is END:
+                    depth -= 1
+                previous = event[0]
+                result.append(event)
+            if self.gray_disabled:
+                wrapper = tag.span(Stream(text),
+                                   style='color:%s' % self.gray_disabled)
+            else:
+                wrapper = tag.strike(Stream(text))
+            children = result + list(wrapper.generate())
+        return [subtree[0]] + children + [subtree[-1]]
+
+    def _field(self, d, subtree):
+        if d.hidden:
+            return [(TEXT, ' ', (None, -1, -1))]
+        e = d.enchant
+        kind, (qname, attrs), pos = subtree[0]
+        children = self._children(subtree)
+        after = []
+        if d.disabled:
+            if not attrs.get('checked'):
+                attrs |= _DISABLED
+            elif attrs.get('type') == 'checkbox':
+                # keep the value of a checked box with a hidden copy
+                copy = list(subtree)
+                if not attrs.get('disabled'):
+                    copy[0] = (kind, (qname, (attrs | _HIDDEN_TYPE) -
+                                      _CHECKED - _ID), pos)
+                after = copy
+                attrs |= _DISABLED
+        if e.tip_script:
+            attrs = attrs | [(QName('onmouseover'), e.tip_script)]
+        result = [(kind, (qname, attrs), pos)] + children + [subtree[-1]]
+        if e.notice_fragment:
+            result.extend(e.notice_fragment.generate())
+        return result + after
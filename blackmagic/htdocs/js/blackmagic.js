@@ -0,0 +1,99 @@
+/* Applies the field decisions computed by the BlackMagicTicketTweaks plugin,
+ * published in the `blackmagic` script data, to the ticket page. */
+jQuery(function($) {
+  var manifest = window.blackmagic;
+  if (!manifest)
+    return;
+
+  // replace every run of direct text children by the new label
+  function relabel(elem, label) {
+    var previous = false;
+    $(elem).contents().each(function() {
+      if (this.nodeType === 3) {
+        if (previous)
+          $(this).remove();
+        else
+          this.nodeValue = label + ":";
+        previous = true;
+      } else {
+        previous = false;
+      }
+    });
+  }
+
+  // move the last run of direct text children into a strike-through or
+  // grayed out element
+  function strike(elem) {
+    var run = [];
+    var previous = false;
+    $(elem).contents().each(function() {
+      if (this.nodeType === 3) {
+        if (!previous)
+          run = [];
+        run.push(this);
+        previous = true;
+      } else {
+        previous = false;
+      }
+    });
+    var wrapper = manifest.gray_disabled ?
+      $("<span>").css("color", manifest.gray_disabled) : $("<strike>");
+    $(elem).append(wrapper.append(run));
+  }
+
+  var tooltip = null;
+  function loadTooltip(callback) {
+    if (!tooltip) {
+      tooltip = $.ajax({url: manifest.tooltip, dataType: "script",
+                        cache: true});
+    }
+    tooltip.done(callback);
+  }
+  function tip(text) {
+    return function() {
+      if (window.tt_Init)
+        Tip(text);
+      else
+        loadTooltip(function() { Tip(text); });
+    };
+  }
+
+  $.each(manifest.fields, function(name, d) {
+    var header = $("#h_" + name);
+    var labels = $("label[for='field-" + name + "']");
+    var field = $("#field-" + name);
+    if (d.hide) {
+      header.text(" ");
+      $("td[headers='h_" + name + "']").text(" ");
+      labels.replaceWith(" ");
+      field.replaceWith(" ");
+      return;
+    }
+    if (d.label !== undefined) {
+      header.each(function() { relabel(this, d.label); });
+      labels.each(function() { relabel(this, d.label); });
+    }
+    if (d.disable) {
+      labels.each(function() { strike(this); });
+      field.each(function() {
+        if (!this.checked) {
+          this.disabled = true;
+        } else if (this.type === "checkbox") {
+          // keep the value of a checked box with a hidden copy
+          if (!this.disabled) {
+            $(this).after($("<input type='hidden'>")
+                          .attr("name", this.name).val(this.value));
+          }
+          this.disabled = true;
+        }
+      });
+    }
+    if (d.tip !== undefined)
+      field.on("mouseover", tip(d.tip));
+    if (d.notice !== undefined)
+      field.after($("<br>"), $("<small>").append($("<em>").html(d.notice)));
+  });
+
+  if (manifest.tooltip && !manifest.tooltip_lazy)
+    loadTooltip($.noop);
+});
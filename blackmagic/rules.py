@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2008 Stephen Hansen <shansen@advpubtech.com>
+# Copyright (C) 2009 Rowan Wookey <support@obsidianproject.co.uk>
+# Copyright (C) 2008-2009 www.obsidianproject.co.uk
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+ONDENIAL_DISABLE = 'disable'
+ONDENIAL_HIDE = 'hide'
+
+
+class Enchantment(object):
+    """The compiled `[blackmagic]` settings of one ticket field."""
+
+    __slots__ = ('field', 'permissions', 'disable', 'hide', 'label',
+                 'notice', 'tip', 'ondenial', '_notice_fragment', 'tip_script')
+
+    def __init__(self, config, field):
+        get = lambda name, default=None: \
+            config.get('blackmagic', '%s.%s' % (field, name), default)
+        self.field = field
+        self.permissions = tuple(x.strip() for x in
+                                 get('permission', '').upper().split(',')
+                                 if x.strip())
+        self.disable = bool(get('disable', False))
+        self.hide = bool(get('hide', False))
+        self.label = get('label')
+        self.notice = get('notice') or None
+        self.tip = get('tip') or None
+        if get('ondenial', ONDENIAL_DISABLE) == ONDENIAL_HIDE:
+            self.ondenial = ONDENIAL_HIDE
+        else:
+            self.ondenial = ONDENIAL_DISABLE
+        self._notice_fragment = None
+        self.tip_script = self.tip and \
+            "Tip('%s')" % self.tip.replace(r"'", r"\'")
+
+    def __repr__(self):
+        return '<Enchantment %s %r>' % (self.field, dict(
+            (name, getattr(self, name)) for name in self.__slots__
+            if name not in ('field', '_notice_fragment', 'tip_script')))
+
+    @property
+    def notice_fragment(self):
+        """The markup added after the field for its notice, built on first
+        use since only the stream filter needs it."""
+        if self.notice and self._notice_fragment is None:
+            from genshi.builder import tag
+            from genshi.core import Markup
+            self._notice_fragment = \
+                tag.br() + tag.small()(tag.em()(Markup(self.notice)))
+        return self._notice_fragment
+
+    def hides_on_denial(self):
+        return bool(self.permissions) and self.ondenial == ONDENIAL_HIDE
+
+
+class FieldDecision(object):
+    """What to do with one enchanted field on the page being rendered."""
+
+    __slots__ = ('enchant', 'hidden', 'disabled')
+
+    def __init__(self, enchant, hidden, disabled):
+        self.enchant = enchant
+        self.hidden = hidden
+        self.disabled = disabled
+
+
+class RuleTable(object):
+    """Snapshot of the `[blackmagic]` section, compiled once."""
+
+    __slots__ = ('enchants', 'type_permissions', 'gray_disabled',
+                 'guarded_fields', 'field_permissions', 'exempt_actions')
+
+    def __init__(self, config):
+        tweaks = config.get('blackmagic', 'tweaks', '')
+        self.enchants = dict((field, Enchantment(config, field))
+                             for field in (x.strip() for x in
+                                           tweaks.split(','))
+                             if field)
+        self.type_permissions = dict(
+            (name[len('ticket_type.'):].lower(), value)
+            for name, value in config.options('blackmagic')
+            if name.startswith('ticket_type.') and value)
+        # actions the policy never decides on: the user-defined permissions
+        # and the ticket type permissions, which it checks itself
+        self.exempt_actions = frozenset(
+            config.getlist('blackmagic', 'permissions', [])) | \
+            frozenset(self.type_permissions.itervalues())
+        self.gray_disabled = config.get('blackmagic', 'gray_disabled', '')
+        # the fields whose outcome depends on the permissions of the user,
+        # and these permissions
+        self.guarded_fields = tuple(
+            e for e in self.enchants.itervalues()
+            if e.permissions and not e.hide and not e.disable)
+        self.field_permissions = frozenset(
+            perm for e in self.guarded_fields for perm in e.permissions)
+
+    def field_decisions(self, held):
+        """Return the `FieldDecision`s of all the enchanted fields for a
+        user holding the `held` subset of `field_permissions`."""
+        decisions = []
+        for e in self.enchants.itervalues():
+            disabled = e.disable
+            hidden = e.hide
+            # if the user has none of the permissions hide/disable depending
+            # on the denial setting
+            if e.permissions and not hidden and not disabled and \
+                    held.isdisjoint(e.permissions):
+                if e.ondenial == ONDENIAL_HIDE:
+                    hidden = True
+                else:
+                    disabled = True
+            decisions.append(FieldDecision(e, hidden, disabled))
+        return decisions
+
+    def ticket_type_permission(self, ticket_type):
+        """Return the permission required for tickets of `ticket_type`, or
+        `None` if the type isn't restricted."""
+        return self.type_permissions.get(('%s' % ticket_type).lower())
+
+
+class ColumnPlan(object):
+    """Redaction actions for the enchanted columns of one report or query
+    result, worked out once from its headers rather than for every cell.
+
+    `columns` is a sequence of `(key, name)` pairs, where `key` addresses the
+    column in a row. Columns which aren't enchanted, or only relabelled, are
+    left out of the plan.
+    """
+
+    __slots__ = ('blank', 'guarded')
+
+    def __init__(self, enchants, columns):
+        self.blank = []
+        self.guarded = []
+        for key, name in columns:
+            e = enchants.get(name)
+            if e is None:
+                continue
+            if e.hide:
+                self.blank.append(key)
+            elif e.hides_on_denial():
+                self.guarded.append((key, e.permissions))
+
+    def __nonzero__(self):
+        return bool(self.blank or self.guarded)
+
+    def redacted(self, tid, has_permission):
+        """Return the keys of the columns to blank for ticket `tid`."""
+        keys = list(self.blank)
+        for key, permissions in self.guarded:
+            for perm in permissions:
+                if not has_permission(perm, tid):
+                    keys.append(key)
+                    break
+        return keys
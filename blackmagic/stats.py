@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2008 Stephen Hansen <shansen@advpubtech.com>
+# Copyright (C) 2009 Rowan Wookey <support@obsidianproject.co.uk>
+# Copyright (C) 2008-2009 www.obsidianproject.co.uk
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import json
+import re
+import threading
+import time
+
+from trac.core import Component, implements
+from trac.web.api import IRequestHandler
+
+
+class PerformanceStats(object):
+    """Thread-safe performance counters of the plugin hooks.
+
+    For each hook the number of calls, the cumulative and the maximum wall
+    time are recorded, next to plain counters such as the number of tickets
+    loaded from the database. If `interval` is set, a summary line is
+    written to `log` at most every `interval` seconds.
+    """
+
+    def __init__(self, log=None, interval=0):
+        self.log = log
+        self.interval = interval
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.since = time.time()
+            self._hooks = {}
+            self._counters = {}
+            self._next_log = self.since + self.interval
+
+    def record(self, hook, elapsed):
+        """Account for a call to `hook` which took `elapsed` seconds."""
+        with self._lock:
+            timing = self._hooks.get(hook)
+            if timing is None:
+                timing = self._hooks[hook] = [0, 0.0, 0.0]
+            timing[0] += 1
+            timing[1] += elapsed
+            if elapsed > timing[2]:
+                timing[2] = elapsed
+            if not self.interval:
+                return
+            now = time.time()
+            if now < self._next_log:
+                return
+            self._next_log = now + self.interval
+        if self.log:
+            self.log.info("BlackMagic stats: %s", self.summary())
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def snapshot(self):
+        """Return the counters as a dict ready to be serialized."""
+        with self._lock:
+            hooks = dict((hook, {'calls': calls, 'total': total, 'max': max_,
+                                 'mean': total / calls})
+                         for hook, (calls, total, max_)
+                         in self._hooks.iteritems())
+            counters = dict(self._counters)
+            since = self.since
+        return {'since': since, 'uptime': time.time() - since,
+                'hooks': hooks, 'counters': counters}
+
+    def summary(self):
+        """Return the counters as a single line."""
+        snapshot = self.snapshot()
+        hooks = ' '.join('%s=%d/%.3fs/%.3fs' % (hook, t['calls'], t['total'],
+                                                t['max'])
+                         for hook, t in sorted(snapshot['hooks'].items()))
+        counters = ' '.join('%s=%d' % item
+                            for item in sorted(snapshot['counters'].items()))
+        return '%s %s' % (hooks, counters)
+
+
+class BlackMagicStatsModule(Component):
+    """Serves the performance counters of the plugin as JSON, at
+    `/blackmagic/stats`, to users having the `TRAC_ADMIN` permission."""
+
+    implements(IRequestHandler)
+
+    # IRequestHandler methods
+
+    def match_request(self, req):
+        return re.match(r'/blackmagic/stats/?$', req.path_info) is not None
+
+    def process_request(self, req):
+        from .blackmagic import BlackMagicTicketTweaks
+        req.perm.require('TRAC_ADMIN')
+        stats = BlackMagicTicketTweaks(self.env).stats
+        req.send(json.dumps(stats.snapshot(), sort_keys=True),
+                 'application/json')
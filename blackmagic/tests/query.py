@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2008 Stephen Hansen <shansen@advpubtech.com>
+# Copyright (C) 2009 Rowan Wookey <support@obsidianproject.co.uk>
+# Copyright (C) 2008-2009 www.obsidianproject.co.uk
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import csv
+import re
+import unittest
+
+from trac.perm import PermissionSystem
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.batch import BatchModifyModule
+from trac.ticket.model import Ticket
+from trac.ticket.query import QueryModule
+from trac.ticket.web_ui import TicketModule
+from trac.web.api import RequestDone
+
+from blackmagic.blackmagic import BlackMagicTicketTweaks
+
+
+class RestrictedQueryTestCase(unittest.TestCase):
+    """Queries and batch modifications of a user who may neither see the
+    tasks nor the summaries, with `restrict_query_types` enabled."""
+
+    def setUp(self):
+        # the ticket module provides the templates of the feeds
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', TicketModule,
+                                           'blackmagic.*'])
+        config = self.env.config
+        config.set('trac', 'permission_policies',
+                   'BlackMagicTicketTweaks, DefaultPermissionPolicy, '
+                   'LegacyAttachmentPolicy')
+        config.set('blackmagic', 'permissions', 'TASK_VIEW, SUMMARY_VIEW')
+        config.set('blackmagic', 'restrict_query_types', 'true')
+        config.set('blackmagic', 'ticket_type.task', 'TASK_VIEW')
+        config.set('blackmagic', 'tweaks', 'summary,description')
+        config.set('blackmagic', 'summary.permission', 'SUMMARY_VIEW')
+        config.set('blackmagic', 'summary.ondenial', 'hide')
+        config.set('blackmagic', 'description.hide', 'true')
+        config.set('query', 'default_query', '?status=!closed&order=id')
+        config.set('query', 'items_per_page', '2')
+        perm = PermissionSystem(self.env)
+        perm.grant_permission('alice', 'TRAC_ADMIN')
+        perm.grant_permission('bob', 'TICKET_VIEW')
+        perm.grant_permission('bob', 'TICKET_BATCH_MODIFY')
+        # tickets 1, 4 and 7 are the tasks bob may not see
+        for i in range(9):
+            ticket = Ticket(self.env)
+            ticket['summary'] = 'summary %d' % (i + 1)
+            ticket['description'] = 'description %d' % (i + 1)
+            ticket['reporter'] = 'alice'
+            ticket['type'] = ('task', 'defect', 'enhancement')[i % 3]
+            ticket['status'] = 'new'
+            ticket.insert()
+        self.bm = BlackMagicTicketTweaks(self.env)
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _query(self, authname='bob', **args):
+        """Process a query request through the request filter, returning
+        the template data of the page or the content sent."""
+        req = MockRequest(self.env, authname=authname, path_info='/query',
+                          args=args)
+        handler = self.bm.pre_process_request(req, QueryModule(self.env))
+        try:
+            return handler.process_request(req)[1]
+        except RequestDone:
+            return req.response_sent.getvalue()
+
+    def _export(self, format, **args):
+        content = self._query(format=format, **args)
+        delimiter = '\t' if format == 'tab' else ','
+        rows = list(csv.reader(content.lstrip('\xef\xbb\xbf').splitlines(),
+                               delimiter=delimiter))
+        return rows[0], rows[1:]
+
+    def _batch_modify(self, authname='bob', **args):
+        req = MockRequest(self.env, authname=authname, method='POST',
+                          path_info='/batchmodify', args=args)
+        self.bm.pre_process_request(req, BatchModifyModule(self.env))
+        return req
+
+    def test_query_counts_visible_tickets(self):
+        data = self._query(status='!closed', order='id', max='2', page='2')
+        self.assertEqual(6, data['query'].num_items)
+        self.assertEqual([5, 6], [t['id'] for t in data['tickets']])
+
+    def test_query_last_page(self):
+        data = self._query(status='!closed', order='id', max='4', page='2')
+        self.assertEqual(6, data['query'].num_items)
+        self.assertEqual([8, 9], [t['id'] for t in data['tickets']])
+
+    def test_query_keeps_constraints(self):
+        data = self._query(status='!closed', order='id')
+        self.assertEqual([{'status': ['!closed']}],
+                         data['query'].constraints)
+        self.assertNotIn('type=', data['query'].get_href(self.env.href))
+
+    def test_query_unrestricted_user(self):
+        data = self._query(authname='alice', status='!closed', order='id',
+                           max='0')
+        self.assertEqual(9, data['query'].num_items)
+
+    def test_query_combined_type_constraint(self):
+        data = self._query(status='!closed', order='id',
+                           type=['task', 'defect'], max='0')
+        self.assertEqual([2, 5, 8], [t['id'] for t in data['tickets']])
+
+    def test_csv_export_redacted(self):
+        header, rows = self._export('csv', status='!closed', order='id',
+                                    col=['id', 'summary', 'type'])
+        # labelled with the field names before Trac 1.2
+        self.assertEqual(['id', 'summary', 'type'],
+                         [label.lower() for label in header])
+        self.assertEqual([['2', '', 'defect'], ['3', '', 'enhancement'],
+                          ['5', '', 'defect'], ['6', '', 'enhancement'],
+                          ['8', '', 'defect'], ['9', '', 'enhancement']],
+                         rows)
+
+    def test_tab_export_redacted(self):
+        header, rows = self._export('tab', status='!closed', order='id',
+                                    col=['id', 'summary'])
+        self.assertEqual([['2', ''], ['3', ''], ['5', ''], ['6', ''],
+                          ['8', ''], ['9', '']], rows)
+
+    def test_export_of_default_query_is_unlimited(self):
+        header, rows = self._export('csv')
+        self.assertEqual(['2', '3', '5', '6', '8', '9'],
+                         [row[0] for row in rows])
+
+    def test_export_keeps_explicit_max(self):
+        header, rows = self._export('csv', status='!closed', order='id',
+                                    max='3')
+        self.assertEqual(['2', '3', '5'], [row[0] for row in rows])
+
+    def test_rss_redacted(self):
+        content = self._query(format='rss', status='!closed', order='id',
+                              max='0')
+        self.assertEqual(['#2: ', '#3: ', '#5: ', '#6: ', '#8: ', '#9: '],
+                         re.findall(r'<title>(#\d+: [^<]*)</title>',
+                                    content))
+        self.assertNotIn('description ', content)
+
+    def test_rss_unrestricted_user_sees_summaries(self):
+        content = self._query(authname='alice', format='rss',
+                              status='!closed', order='id')
+        self.assertIn('<title>#1: summary 1</title>', content)
+        self.assertNotIn('description ', content)
+
+    def test_batch_modify_of_protected_field_rejected(self):
+        self.assertRaises(RequestDone, self._batch_modify,
+                          selected_tickets='2,3',
+                          batchmod_value_summary='changed')
+        self.assertEqual('summary 2', Ticket(self.env, 2)['summary'])
+
+    def test_batch_modify_to_denied_type_rejected(self):
+        self.assertRaises(RequestDone, self._batch_modify,
+                          selected_tickets='2,3', batchmod_value_type='task')
+
+    def test_batch_modify_of_other_field_accepted(self):
+        req = self._batch_modify(selected_tickets='2,3',
+                                 batchmod_value_priority='major')
+        self.assertEqual([], req.chrome['warnings'])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(RestrictedQueryTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
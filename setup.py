@@ -23,6 +23,8 @@ setup(
     license="BSD 3-Clause",
     url="http://trac-hacks.org/wiki/BlackMagicTicketTweaksPlugin",
     packages=find_packages(exclude=['*.tests*']),
+    install_requires=['Trac >= 1.0'],
+    test_suite='blackmagic.tests.test_suite',
     package_data={
         'blackmagic': ['htdocs/js/*.js']
     },